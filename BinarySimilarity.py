@@ -0,0 +1,200 @@
+import heapq
+import os
+import struct
+import zlib
+
+ELF_MAGIC = b'\x7fELF'
+ELFCLASS64 = 2
+ELFDATA2MSB = 2
+SHT_SYMTAB = 2
+SHT_NOBITS = 8
+STT_FUNC = 2
+
+
+class ElfText:
+    """
+        The .text section of an ELF file and the function symbols inside it.
+
+        == ELF header (after e_ident) ==
+        32 bit: e_shoff at 0x20, e_shentsize e_shnum e_shstrndx (UInt16) at 0x2e
+        64 bit: e_shoff at 0x28, e_shentsize e_shnum e_shstrndx (UInt16) at 0x3a
+
+        == Section header ==
+        32 bit: name type flags addr offset size link info addralign entsize, all UInt32
+        64 bit: name type (UInt32) flags addr offset size (UInt64) link info (UInt32) addralign entsize (UInt64)
+
+        == Symbol ==
+        32 bit: name value size (UInt32) info other (UInt8) shndx (UInt16)
+        64 bit: name (UInt32) info other (UInt8) shndx (UInt16) value size (UInt64)
+    """
+
+    def __init__(self, text, functions):
+        self.text = text
+        # name -> bytes of the function
+        self.functions = functions
+        return
+
+    @classmethod
+    def load(cls, filename):
+        """
+            Raises IOError for a file that cannot be read or parsed, truncated or malformed ELF included.
+        """
+        with open(filename, 'rb') as file_handle:
+            data = file_handle.read()
+        try:
+            return cls.parse(data, filename)
+        except (struct.error, IndexError, ValueError, OverflowError) as e:
+            raise IOError("ElfText: '%s' is malformed: %s" % (filename, e))
+
+    @classmethod
+    def parse(cls, data, filename):
+        if data[0:4] != ELF_MAGIC:
+            raise IOError("ElfText: '%s' is not an ELF file" % filename)
+        is64 = data[4] == ELFCLASS64
+        order = '>' if data[5] == ELFDATA2MSB else '<'
+
+        if is64:
+            shoff, = struct.unpack_from(order + "Q", data, 0x28)
+            shentsize, shnum, shstrndx = struct.unpack_from(order + "3H", data, 0x3a)
+            section_format = order + "IIQQQQIIQQ"
+        else:
+            shoff, = struct.unpack_from(order + "I", data, 0x20)
+            shentsize, shnum, shstrndx = struct.unpack_from(order + "3H", data, 0x2e)
+            section_format = order + "10I"
+
+        # (name, type, addr, offset, size, link)
+        sections = []
+        for index in range(shnum):
+            name, kind, _, addr, offset, size, link, _, _, _ = struct.unpack_from(section_format, data,
+                                                                                  shoff + index * shentsize)
+            sections.append((name, kind, addr, offset, size, link))
+        if not sections:
+            raise IOError("ElfText: '%s' has no section headers" % filename)
+
+        names_offset = sections[shstrndx][3]
+        text_index = None
+        for index, section in enumerate(sections):
+            if ElfText.string_at(data, names_offset + section[0]) == b'.text' and section[1] != SHT_NOBITS:
+                text_index = index
+                break
+        if text_index is None:
+            raise IOError("ElfText: '%s' has no .text section" % filename)
+
+        _, _, text_addr, text_offset, text_size, _ = sections[text_index]
+        text = data[text_offset: text_offset + text_size]
+
+        functions = {}
+        for _, kind, _, offset, size, link in sections:
+            if kind != SHT_SYMTAB:
+                continue
+            strings_offset = sections[link][3]
+            for symbol in ElfText.symbols(data, offset, size, is64, order):
+                name, info, shndx, value, symbol_size = symbol
+                if info & 0xf != STT_FUNC or shndx != text_index or symbol_size == 0:
+                    continue
+                start = value - text_addr
+                functions[ElfText.string_at(data, strings_offset + name)] = text[start: start + symbol_size]
+
+        return cls(text, functions)
+
+    @staticmethod
+    def symbols(data, offset, size, is64, order):
+        """
+            Yields (name, info, shndx, value, size) for the symbol table at offset.
+        """
+        if is64:
+            layout = struct.Struct(order + "IBBHQQ")
+            for name, info, _, shndx, value, symbol_size in layout.iter_unpack(data[offset: offset + size]):
+                yield name, info, shndx, value, symbol_size
+        else:
+            layout = struct.Struct(order + "IIIBBH")
+            for name, value, symbol_size, info, _, shndx in layout.iter_unpack(data[offset: offset + size]):
+                yield name, info, shndx, value, symbol_size
+
+    @staticmethod
+    def string_at(data, offset):
+        return data[offset: data.index(b'\x00', offset)]
+
+
+class BinarySimilarity:
+    """
+        Similarity of two ELF binaries in [0, 1], 1.0 for identical code, computed in process.
+
+        "minhash" compares bottom-k sketches of the shingle_size byte shingles of .text, an estimate of the
+        Jaccard similarity of the two shingle sets.  "functions" is the share of function bytes (by symbol)
+        whose contents are unchanged, and falls back to "minhash" for stripped binaries.
+
+        The features of the baseline binary are computed once per program and kept while its size and
+        modification time stay the same.
+    """
+    METHODS = ("minhash", "functions")
+
+    def __init__(self, method="minhash", shingle_size=8, sketch_size=256):
+        if method not in BinarySimilarity.METHODS:
+            raise LookupError("BinarySimilarity: unknown method '%s'" % method)
+        self.method = method
+        self.shingle_size = shingle_size
+        self.sketch_size = sketch_size
+        # filename -> ((size, mtime), features)
+        self.cache = {}
+        return
+
+    def similarity(self, baseline_file, mutant_file):
+        """
+            None when either binary is missing or unreadable, e.g. when gcc failed to build the mutant.
+        """
+        try:
+            baseline = self.features(baseline_file, cached=True)
+            mutant = self.features(mutant_file, cached=False)
+        except OSError as e:
+            print("BinarySimilarity: " + str(e))
+            return None
+        if baseline["text"] == mutant["text"]:
+            return 1.0
+        if self.method == "functions" and baseline["functions"] and mutant["functions"]:
+            return BinarySimilarity.function_similarity(baseline["functions"], mutant["functions"])
+        return BinarySimilarity.sketch_similarity(baseline["sketch"], mutant["sketch"], self.sketch_size)
+
+    def features(self, filename, cached):
+        stat = os.stat(filename)
+        version = (stat.st_size, stat.st_mtime_ns)
+        if cached:
+            entry = self.cache.get(filename)
+            if entry is not None and entry[0] == version:
+                return entry[1]
+
+        elf = ElfText.load(filename)
+        features = {"text": zlib.crc32(elf.text) ^ (len(elf.text) << 32),
+                    "sketch": self.sketch(elf.text),
+                    "functions": {name: (zlib.crc32(code), len(code)) for name, code in elf.functions.items()}}
+        if cached:
+            self.cache[filename] = (version, features)
+        return features
+
+    def sketch(self, text):
+        """
+            The sketch_size smallest distinct hashes of the shingles of text.
+        """
+        size = self.shingle_size
+        hashes = set(zlib.crc32(text[i: i + size]) for i in range(max(len(text) - size + 1, 1)))
+        return frozenset(heapq.nsmallest(self.sketch_size, hashes))
+
+    @staticmethod
+    def sketch_similarity(sketch_a, sketch_b, sketch_size):
+        union = heapq.nsmallest(sketch_size, sketch_a | sketch_b)
+        if not union:
+            return 1.0
+        return sum(1 for value in union if value in sketch_a and value in sketch_b) / len(union)
+
+    @staticmethod
+    def function_similarity(functions_a, functions_b):
+        total = 0
+        same = 0
+        for name in functions_a.keys() | functions_b.keys():
+            a = functions_a.get(name)
+            b = functions_b.get(name)
+            size = max(a[1] if a else 0, b[1] if b else 0)
+            total += size
+            if a == b:
+                same += size
+        return same / total if total else 1.0
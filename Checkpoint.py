@@ -0,0 +1,56 @@
+import os
+import pickle
+import struct
+import zlib
+
+from GcovIO import GcovIO
+
+CHECKPOINT_VERSION = 1
+CHECKPOINT_FILE_MAGIC = b'pfck'
+
+
+class Checkpoint:
+    """
+        On-disk snapshot of a fuzzing campaign: optimization level, next iteration, RNG state and the solver
+        statistics and constraint pools of every function that has any.  Functions without state are left
+        out, so a snapshot stays small however large the program is.
+
+        == File ==
+        [Magic] + [Version(UInt32)] + [zlib compressed pickle of the state dict]
+
+        The file is replaced atomically, a run killed while saving keeps the previous snapshot.
+    """
+
+    def __init__(self, filename):
+        self.filename = os.path.abspath(filename)
+        return
+
+    def save(self, state):
+        payload = zlib.compress(pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL), 1)
+        GcovIO.write_file_atomic(self.filename, CHECKPOINT_FILE_MAGIC + struct.pack("<I", CHECKPOINT_VERSION) + payload)
+        return
+
+    def load(self):
+        """
+            Returns the saved state, or None if there is no usable checkpoint.
+        """
+        try:
+            with open(self.filename, 'rb') as file_handle:
+                data = file_handle.read()
+        except OSError:
+            return None
+
+        if len(data) < 8 or data[0:4] != CHECKPOINT_FILE_MAGIC:
+            return None
+        version, = struct.unpack_from("<I", data, 4)
+        if version != CHECKPOINT_VERSION:
+            return None
+        try:
+            return pickle.loads(zlib.decompress(data[8:]))
+        except (zlib.error, pickle.UnpicklingError, EOFError):
+            return None
+
+    def remove(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+        return
@@ -1,42 +1,282 @@
-import os
-import re
+import random
+from bisect import bisect_left
+
+from BinarySimilarity import BinarySimilarity
+
+# One engine per run, so the features of every baseline binary are computed once
+SIMILARITY = BinarySimilarity()
 
 
 def calculate_similarity(gcda):
     file_name = gcda.target_binary_name
-    cmd = "radiff2 -s " + file_name + " " + file_name + "_mut"
-    result = os.popen(cmd).read()
-    pattern = r"similarity:\s([0-9.]+)"
-    match = re.search(pattern, result)
-    sim = match.group(1)
-    return float(sim)
+    return SIMILARITY.similarity(file_name, file_name + "_mut")
+
+
+class NoveltyIndex:
+    """
+        Sorted similarity values seen so far.  A value within tolerance of a stored one is a hit on that
+        bucket and not novel, so lookups are O(log n) and near-duplicates do not grow the index.
+    """
+
+    def __init__(self, tolerance=1e-4):
+        self.tolerance = tolerance
+        self.values = []
+        # hits[i] counts the values that fell into the bucket of values[i], the first one included
+        self.hits = []
+
+    def __len__(self):
+        return len(self.values)
+
+    def __contains__(self, value):
+        return self.find(value) is not None
+
+    def find(self, value):
+        """
+            Position of the stored value nearest to value if it is within tolerance, else None.
+        """
+        position = bisect_left(self.values, value)
+        nearest = None
+        for candidate in (position - 1, position):
+            if 0 <= candidate < len(self.values) and abs(self.values[candidate] - value) <= self.tolerance:
+                if nearest is None or abs(self.values[candidate] - value) < abs(self.values[nearest] - value):
+                    nearest = candidate
+        return nearest
+
+    def add(self, value):
+        """
+            Records value, returns True if it opened a new bucket.
+        """
+        position = self.find(value)
+        if position is not None:
+            self.hits[position] += 1
+            return False
+        position = bisect_left(self.values, value)
+        self.values.insert(position, value)
+        self.hits.insert(position, 1)
+        return True
+
+    def buckets(self):
+        return list(zip(self.values, self.hits))
+
+
+class WeightedSampler:
+    """
+        Fenwick tree over non-negative slot weights: O(log n) update, append and weighted sampling.
+    """
+
+    def __init__(self):
+        self.weights = []
+        # tree[i] (1 based) sums the weights of slots (i - lowbit(i), i]
+        self.tree = [0.0]
+
+    def __len__(self):
+        return len(self.weights)
+
+    def prefix(self, count):
+        total = 0.0
+        while count > 0:
+            total += self.tree[count]
+            count -= count & -count
+        return total
+
+    def total(self):
+        return self.prefix(len(self.weights))
+
+    def append(self, weight):
+        self.weights.append(weight)
+        index = len(self.weights)
+        self.tree.append(weight + self.prefix(index - 1) - self.prefix(index - (index & -index)))
+        return index - 1
+
+    def update(self, slot, weight):
+        delta = weight - self.weights[slot]
+        self.weights[slot] = weight
+        index = slot + 1
+        while index < len(self.tree):
+            self.tree[index] += delta
+            index += index & -index
+
+    def sample(self, rng=random):
+        """
+            Returns a slot with probability proportional to its weight, or None if every weight is zero.
+        """
+        total = self.total()
+        if total <= 0:
+            return None
+        target = rng.random() * total
+        index = 0
+        step = 1 << (len(self.weights).bit_length())
+        while step:
+            following = index + step
+            if following < len(self.tree) and self.tree[following] <= target:
+                index = following
+                target -= self.tree[following]
+            step >>= 1
+        # Rounding can end the descent on an empty slot
+        if index >= len(self.weights) or self.weights[index] <= 0:
+            live = [slot for slot, weight in enumerate(self.weights) if weight > 0]
+            return live[-1] if live else None
+        return index
+
+    def rebuild(self):
+        weights = self.weights
+        self.weights = []
+        self.tree = [0.0]
+        for weight in weights:
+            self.append(weight)
+
+
+class PoolEntry:
+    __slots__ = ('slot', 'constraint', 'finds', 'uses', 'solve_seconds', 'last_event')
+
+    def __init__(self, slot, constraint, solve_seconds, clock):
+        self.slot = slot
+        self.constraint = constraint
+        self.finds = 0
+        self.uses = 0
+        self.solve_seconds = solve_seconds
+        self.last_event = clock
 
 
 class ConstraintPool:
-    def __init__(self, ):
+    """
+        Constraint sets whose mutants produced new behaviour, picked for later solves by an AFL style power
+        schedule.  The energy of an entry grows with the new similarities and bugs its children found, decays
+        with the schedule rounds since it was added or last found something (half life half_life rounds), and
+        shrinks with its solve time and with how often it was already used.  Beyond max_size entries the one
+        with the least energy is evicted.
+    """
+
+    def __init__(self, tolerance=1e-4, max_size=256, half_life=50.0):
         self.constraint = None
-        self.constraint_pool = []
-        self.similarity_list = []
+        self.parent = None
+        self.solve_seconds = 0.0
+        self.similarity_index = NoveltyIndex(tolerance)
+        self.max_size = max_size
+        self.half_life = half_life
+        self.entries = []
+        self.free_slots = []
+        self.sampler = WeightedSampler()
+        self.clock = 0
+        # Recency is a weight that doubles every half_life rounds, counted from epoch to keep it finite
+        self.epoch = 0
 
-    def record(self, constraint):
+    def __len__(self):
+        return len(self.entries) - len(self.free_slots)
+
+    def record(self, constraint, parent=None):
         self.constraint = constraint
+        self.parent = parent
+        self.solve_seconds = 0.0
+
+    def clear_record(self):  # before a mutation, which records again only if it comes from a solution
+        self.record(None)
+
+    def record_cost(self, seconds):
+        self.solve_seconds = seconds
+
+    def energy(self, entry):
+        return ((1 + entry.finds) / (1 + entry.uses) ** 0.5 / (1 + entry.solve_seconds) *
+                2 ** ((entry.last_event - self.epoch) / self.half_life))
 
     def add(self):
-        self.constraint_pool.append(self.constraint)
+        if self.free_slots:
+            slot = self.free_slots.pop()
+            entry = PoolEntry(slot, self.constraint, self.solve_seconds, self.clock)
+            self.entries[slot] = entry
+            self.sampler.update(slot, self.energy(entry))
+        else:
+            entry = PoolEntry(len(self.entries), self.constraint, self.solve_seconds, self.clock)
+            self.entries.append(entry)
+            self.sampler.append(self.energy(entry))
+        if len(self) > self.max_size:
+            self.evict()
+        return entry
+
+    def evict(self):
+        weakest = min((entry for entry in self.entries if entry is not None), key=self.energy)
+        self.entries[weakest.slot] = None
+        self.sampler.update(weakest.slot, 0.0)
+        self.free_slots.append(weakest.slot)
 
     def get(self):
-        return self.constraint_pool
+        return [entry.constraint for entry in self.entries if entry is not None]
 
     def get_constraint(self):
         return self.constraint
 
-    def schedule(self, gcda):
+    def select(self, accept=None):
+        """
+            Picks an entry by energy and counts the use, None when the pool is empty or accept(entry) rejects
+            the pick.
+        """
+        slot = self.sampler.sample()
+        if slot is None:
+            return None
+        entry = self.entries[slot]
+        if accept is not None and not accept(entry):
+            return None
+        entry.uses += 1
+        self.sampler.update(slot, self.energy(entry))
+        return entry
+
+    def reward(self, entry):
+        if self.entries[entry.slot] is not entry:
+            return
+        entry.finds += 1
+        entry.last_event = self.clock
+        self.sampler.update(entry.slot, self.energy(entry))
+
+    def tick(self):
+        self.clock += 1
+        if self.clock - self.epoch > 64 * self.half_life:
+            self.epoch = self.clock
+            for entry in self.entries:
+                if entry is not None:
+                    self.sampler.weights[entry.slot] = self.energy(entry)
+            self.sampler.rebuild()
+
+    def checkpoint_state(self, encode):
+        """
+            Plain data of the pool, encode turns a constraint list into picklable data.
+        """
+        return {"similarity": (list(self.similarity_index.values), list(self.similarity_index.hits)),
+                "clock": self.clock,
+                "epoch": self.epoch,
+                "entries": [(encode(entry.constraint), entry.finds, entry.uses, entry.solve_seconds, entry.last_event)
+                            for entry in self.entries if entry is not None]}
+
+    def restore_state(self, state, decode):
+        self.similarity_index.values, self.similarity_index.hits = (list(items) for items in state["similarity"])
+        self.clock = state["clock"]
+        self.epoch = state["epoch"]
+        self.entries = []
+        self.free_slots = []
+        self.sampler = WeightedSampler()
+        for constraint, finds, uses, solve_seconds, last_event in state["entries"]:
+            entry = PoolEntry(len(self.entries), decode(constraint), solve_seconds, last_event)
+            entry.finds = finds
+            entry.uses = uses
+            self.entries.append(entry)
+            self.sampler.append(self.energy(entry))
+
+    def schedule(self, gcda, bug=False):
+        self.tick()
         sim = calculate_similarity(gcda)
         print("similarity: " + str(sim))
-        if sim not in self.similarity_list and sim != 1.0:
+        # No similarity without a mutant binary, a compiler crash still counts through bug
+        novel = sim is not None and sim != 1.0 and self.similarity_index.add(sim)
+        if self.constraint is None:
+            # e.g. a perturb mutant, there is no constraint set to keep or parent to reward
+            print("new similarity: " + str(sim) if novel else "no new similarity found")
+            return
+        if (novel or bug) and self.parent is not None:
+            self.reward(self.parent)
+        if novel:
             print("new similarity: " + str(sim))
-            self.similarity_list.append(sim)
-            self.constraint_pool.append(self.constraint)
-            print("constraint pool: " + str(self.constraint_pool))
+            self.add()
+            print("constraint pool: " + str(len(self)) + " entries")
         else:
             print("no new similarity found")
+        # Consumed, a later schedule() without a new mutation must not keep or reward it again
+        self.clear_record()
@@ -0,0 +1,389 @@
+import random
+from collections import deque
+
+from GcovGraph import GcovGraph
+
+
+class FlowSampler:
+    """
+        Draws flow-consistent counter vectors for one GcovConstraint without an SMT solver.
+
+        The conservation equations of GcovConstraint.constraints say that every constrained block has equal
+        incoming and outgoing flow.  Merging the unconstrained entry and exit blocks into one free node, which
+        stands in for gcc's implicit exit to entry arc, turns every valid arc vector into a circulation, which
+        is a non-negative sum of directed cycles.  A cycle cover of the graph is computed once; a sample gives
+        every cycle that avoids the pinned arcs a random weight of at least min_value and spreads exactly the
+        requested value of each pinned arc over the cycles through it.  Fake arcs are not covered, their flow
+        may stay zero.
+
+        perturb() instead starts from existing counters and shifts a delta along one cycle, which keeps a
+        consistent profile consistent without building a new one.
+    """
+
+    def __init__(self, constraint, min_value=10, spread=1014, rng=None):
+        self.constraint = constraint
+        self.min_value = min_value
+        self.spread = spread
+        self.rng = rng if rng is not None else random
+
+        cfg = constraint.cfg()
+        conserved = set(block_constraint.outgoing_edge[0].source_block_number
+                        for block_constraint in constraint.constraints)
+        self.free_node = cfg.node_count
+        sources = [source if source in conserved else self.free_node for source in cfg.sources]
+        destinations = [destination if destination in conserved else self.free_node
+                        for destination in cfg.destinations]
+        self.graph = GcovGraph(sources, destinations, self.free_node + 1)
+        # Fake arcs (calls that may not return) can carry no flow at all
+        self.lower = [0 if cfg.is_fake(position) else min_value for position in range(cfg.arc_count)]
+
+        self.counter_index = cfg.counter_index
+        self.counter_positions = [position for position in range(cfg.arc_count) if cfg.counter_index[position] >= 0]
+        self.counter_positions.sort(key=cfg.counter_index.__getitem__)
+
+        arc_position = {id(arc): position for position, arc in enumerate(constraint.arc_list)}
+        self.equations = [([arc_position[id(arc)] for arc in block_constraint.incoming_edge],
+                           [arc_position[id(arc)] for arc in block_constraint.outgoing_edge])
+                          for block_constraint in constraint.constraints]
+        # Cycle cover, None until first needed, and the number of arcs it could not cover
+        self.cover = None
+        self.uncovered = 0
+        # (counters, arc flows) of the last perturb() result
+        self.perturbed = None
+        return
+
+    def cycle_cover(self):
+        """
+            Simple directed cycles that together use every arc with a positive lower bound that lies on a
+            cycle, the others are counted in uncovered.  An uncovered arc u -> v is closed into a walk by the BFS tree paths
+            free node -> u and v -> free node, and the walk is split into simple cycles, so building the cover
+            costs a few graph traversals instead of one search per arc.  Arcs the free node does not reach
+            fall back to find_cycle.
+        """
+        if self.cover is None:
+            graph = self.graph
+            to_node = self.tree(graph.out_edges, graph.destinations)
+            from_node = self.tree(graph.in_edges, graph.sources)
+            covered = [False] * graph.arc_count
+            cover = []
+            for position in range(graph.arc_count):
+                if covered[position] or self.lower[position] == 0:
+                    continue
+                walk = self.root_walk(position, to_node, from_node)
+                cycles = self.simple_cycles(walk) if walk is not None else [self.find_cycle(position)]
+                if cycles[0] is None:
+                    self.uncovered += 1
+                    continue
+                for cycle in cycles:
+                    if not all(covered[cycle_position] for cycle_position in cycle):
+                        cover.append(cycle)
+                        for cycle_position in cycle:
+                            covered[cycle_position] = True
+            self.cover = cover
+        return self.cover
+
+    def tree(self, edges, other_end):
+        """
+            BFS tree rooted at the free node over edges(node), as parent arc positions per node: -1 for the
+            root and nodes not reached, so paths are followed back until the free node.
+        """
+        parent = [-1] * self.graph.node_count
+        seen = [False] * self.graph.node_count
+        seen[self.free_node] = True
+        queue = deque([self.free_node])
+        while queue:
+            node = queue.popleft()
+            for position in edges(node):
+                next_node = other_end[position]
+                if not seen[next_node]:
+                    seen[next_node] = True
+                    parent[next_node] = position
+                    queue.append(next_node)
+        return parent
+
+    def root_walk(self, position, to_node, from_node):
+        """
+            Arc positions of the closed walk free node -> source, arc position, destination -> free node,
+            or None when the free node does not reach the source or the destination does not reach it.
+        """
+        graph = self.graph
+        source, destination = graph.sources[position], graph.destinations[position]
+        head = []
+        node = source
+        while node != self.free_node:
+            if to_node[node] < 0:
+                return None
+            head.append(to_node[node])
+            node = graph.sources[to_node[node]]
+        head.reverse()
+
+        tail = []
+        node = destination
+        while node != self.free_node:
+            if from_node[node] < 0:
+                return None
+            tail.append(from_node[node])
+            node = graph.destinations[from_node[node]]
+        return head + [position] + tail
+
+    def simple_cycles(self, walk):
+        """
+            Splits a closed walk into simple cycles, cutting one off whenever the walk revisits a node.
+        """
+        graph = self.graph
+        cycles = []
+        stack = []
+        # node -> length of stack when the walk reached it
+        depth = {graph.sources[walk[0]]: 0}
+        for position in walk:
+            stack.append(position)
+            node = graph.destinations[position]
+            if node in depth:
+                cut = depth[node]
+                cycle = stack[cut:]
+                for cycle_position in cycle:
+                    del depth[graph.destinations[cycle_position]]
+                del stack[cut:]
+                depth[node] = cut
+                cycles.append(cycle)
+            else:
+                depth[node] = len(stack)
+        return cycles
+
+    def find_cycle(self, position, avoid=()):
+        """
+            Returns the arc positions of a directed cycle through arc position that uses no arc in avoid,
+            or None.  Breadth first, so the cycle is a shortest one.
+        """
+        graph = self.graph
+        source, destination = graph.sources[position], graph.destinations[position]
+        if source == destination:
+            return [position]
+
+        parent = {destination: None}
+        queue = deque([destination])
+        while queue:
+            node = queue.popleft()
+            for out_position in graph.out_edges(node):
+                if out_position == position or out_position in avoid:
+                    continue
+                next_node = graph.destinations[out_position]
+                if next_node in parent:
+                    continue
+                parent[next_node] = out_position
+                if next_node == source:
+                    cycle = [position]
+                    while next_node != destination:
+                        back_position = parent[next_node]
+                        cycle.append(back_position)
+                        next_node = graph.sources[back_position]
+                    return cycle
+                queue.append(next_node)
+        return None
+
+    def split(self, value, parts):
+        """
+            Random composition of value into parts summands, each at least min_value.
+        """
+        spare = value - parts * self.min_value
+        cuts = sorted(self.rng.randint(0, spare) for _ in range(parts - 1))
+        bounds = [0] + cuts + [spare]
+        return [self.min_value + bounds[i + 1] - bounds[i] for i in range(parts)]
+
+    def sample(self, index, value, pins=None):
+        """
+            Returns counter values (in counter_list order) with counter index equal to value, and the counters
+            of pins ({counter index: value}, at most one) equal to theirs, or None when no weighting of the
+            cycles fits, e.g. a value below min_value or too small for the cycles through its arc.
+        """
+        pinned = {self.counter_positions[index]: value}
+        for pin_index, pin_value in (pins or {}).items():
+            position = self.counter_positions[pin_index]
+            if pinned.get(position, pin_value) != pin_value:
+                return None
+            pinned[position] = pin_value
+        if len(pinned) > 2 or min(pinned.values()) < self.min_value:
+            return None
+        cover = self.cycle_cover()
+        if self.uncovered:
+            return None
+
+        # A shortest cycle through each pinned arc that avoids the other pins, so the pins are independent
+        # whenever the graph allows it
+        cycles = list(cover)
+        for position in pinned:
+            cycle = self.find_cycle(position, avoid=[other for other in pinned if other != position])
+            if cycle is not None:
+                cycles.append(cycle)
+
+        flows = [0] * self.graph.arc_count
+        free_covered = set()
+        through_pins = []
+        for cycle in cycles:
+            if any(position in pinned for position in cycle):
+                through_pins.append(cycle)
+                continue
+            weight = self.min_value + self.rng.randint(0, self.spread)
+            for position in cycle:
+                flows[position] += weight
+            free_covered.update(cycle)
+
+        # groups[pinned arcs of a cycle] = (required, optional) cycles, a cycle is required when it covers an
+        # arc no pin-free cycle covers
+        groups = {}
+        for cycle in through_pins:
+            key = frozenset(position for position in cycle if position in pinned)
+            required, optional = groups.setdefault(key, ([], []))
+            if any(self.lower[position] > 0 and position not in free_covered and position not in pinned
+                   for position in cycle):
+                required.append(cycle)
+            else:
+                optional.append(cycle)
+
+        weights = self.pinned_weights(pinned, groups)
+        if weights is None:
+            return None
+        for cycle, weight in weights:
+            for position in cycle:
+                flows[position] += weight
+
+        if not self.is_consistent(flows):
+            return None
+        return [flows[position] for position in self.counter_positions]
+
+    def pinned_weights(self, pinned, groups):
+        """
+            [(cycle, weight)] for the cycles through pinned arcs, such that the weights through every pinned arc
+            add up to its value.  With two pins the flow through both is drawn first, the rest goes to the
+            cycles through one of them.
+        """
+        empty = ([], [])
+        if len(pinned) == 1:
+            (position, value), = pinned.items()
+            return self.distribute(value, *groups.get(frozenset([position]), empty))
+
+        (first, first_value), (second, second_value) = pinned.items()
+        only_first = groups.get(frozenset([first]), empty)
+        only_second = groups.get(frozenset([second]), empty)
+        both = groups.get(frozenset([first, second]), empty)
+        low = len(both[0]) * self.min_value
+        high = min(first_value - len(only_first[0]) * self.min_value,
+                   second_value - len(only_second[0]) * self.min_value)
+        shares = [self.rng.randint(low, high)] if low <= high else []
+        for shared in shares + [0, low, first_value, second_value]:
+            if not 0 <= shared <= min(first_value, second_value):
+                continue
+            weights = [self.distribute(shared, *both), self.distribute(first_value - shared, *only_first),
+                       self.distribute(second_value - shared, *only_second)]
+            if None not in weights:
+                return weights[0] + weights[1] + weights[2]
+        return None
+
+    def distribute(self, total, required, optional):
+        """
+            Splits total over the required cycles, or over one optional cycle when there are none, each
+            getting at least min_value.  None when that is impossible.
+        """
+        if total == 0:
+            return None if required else []
+        chosen = required or ([self.rng.choice(optional)] if optional else [])
+        if not chosen or total < len(chosen) * self.min_value:
+            return None
+        return list(zip(chosen, self.split(total, len(chosen))))
+
+    def propagate(self, flows):
+        """
+            Fills in the None entries of flows (one per arc) that conservation determines, the way gcov solves
+            the spanning tree: a node with a single unknown arc determines it.  Works on numbers as well as on
+            z3 expressions.  Returns the nodes whose equation was used; the equations of the other nodes still
+            have to hold.
+        """
+        graph = self.graph
+
+        # (arc, sign) per node, self loops cancel out
+        node_arcs = [[(position, 1) for position in graph.in_edges(node) if graph.sources[position] != node] +
+                     [(position, -1) for position in graph.out_edges(node) if graph.destinations[position] != node]
+                     for node in range(graph.node_count)]
+        unknown = [sum(1 for position, _ in arcs if flows[position] is None) for arcs in node_arcs]
+        pending = [node for node, count in enumerate(unknown) if count == 1]
+        used = set()
+        while pending:
+            node = pending.pop()
+            if unknown[node] != 1:
+                continue
+            incoming = 0
+            outgoing = 0
+            missing = None
+            for position, sign in node_arcs[node]:
+                if flows[position] is None:
+                    missing = (position, sign)
+                elif sign > 0:
+                    incoming = incoming + flows[position]
+                else:
+                    outgoing = outgoing + flows[position]
+            position, sign = missing
+            flows[position] = outgoing - incoming if sign > 0 else incoming - outgoing
+            used.add(node)
+            for other in (graph.sources[position], graph.destinations[position]):
+                unknown[other] -= 1
+                if unknown[other] == 1:
+                    pending.append(other)
+        return used
+
+    def arc_flows(self, counters, complete=True):
+        """
+            Reconstructs the flow of every arc from the counters of the instrumented arcs.  Returns None when a
+            flow comes out negative, or when complete is set and some flows stay underdetermined; with complete
+            unset those are left None in the returned list.
+        """
+        flows = [None] * self.graph.arc_count
+        for value, position in zip(counters, self.counter_positions):
+            flows[position] = value
+        self.propagate(flows)
+
+        if any(flow is not None and flow < 0 for flow in flows):
+            return None
+        if complete and any(flow is None for flow in flows):
+            return None
+        return flows
+
+    def perturb(self, counters):
+        """
+            Returns a copy of counters with a random delta added along one cycle of the cycle cover, an entry to
+            exit path being a cycle through the free node.  Conservation is preserved by construction.  A
+            negative delta is only drawn when the flows of the cycle are known, and is bounded so none of them
+            drops below zero.  Returns None when the graph has no cycle.
+
+            The arc flows of the result are kept, so perturbing it again only updates the arcs of the next
+            cycle; other counters are reconstructed once with arc_flows().
+        """
+        cycles = self.cycle_cover()
+        if not cycles:
+            return None
+        cycle = self.rng.choice(cycles)
+
+        if self.perturbed is not None and self.perturbed[0] == counters:
+            flows = self.perturbed[1]
+        else:
+            flows = self.arc_flows(counters, complete=False)
+
+        delta = self.rng.randint(1, self.spread)
+        if (self.rng.random() < 0.5 and flows is not None and
+                all(flows[position] is not None for position in cycle)):
+            delta = -min(delta, min(flows[position] for position in cycle))
+
+        result = list(counters)
+        for position in cycle:
+            index = self.counter_index[position]
+            if index >= 0:
+                result[index] += delta
+            if flows is not None and flows[position] is not None:
+                flows[position] += delta
+        self.perturbed = (result[:], flows) if flows is not None else None
+        return result
+
+    def is_consistent(self, flows):
+        if any(flow < lower for flow, lower in zip(flows, self.lower)):
+            return False
+        return all(sum(flows[i] for i in incoming) == sum(flows[i] for i in outgoing)
+                   for incoming, outgoing in self.equations)
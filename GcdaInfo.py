@@ -1,7 +1,14 @@
+import mmap
 import os
+import struct
+from array import array
 
 import GcovConst
-from GcovIO import GcovIO
+from GcovIO import GcovIO, GcovLazyRecords, GcovLayout, GcovRecordCodec, RECORD_HEADER_LAYOUT
+
+# Counter records that gcc stores with a negative length and no data when all counters are zero
+GCDA_ZERO_ENCODED_TAGS = frozenset([GcovConst.GCOV_TAG_COUNTER_BASE, GcovConst.GCOV_TAG_TIME_PROFILER,
+                                    GcovConst.GCOV_TAG_INTERVAL, GcovConst.GCOV_TAG_POW2])
 
 
 class GCovDataFunctionAnnouncementRecord:
@@ -140,6 +147,19 @@ class GCovDatTopnRecord:
         self.topn = topn
 
 
+# Counter record kind -> (counter attribute, stored with the negative length encoding when all zero)
+GCDA_COUNTER_FIELDS = {GCovDataCounterBaseRecord: ("counters", True),
+                       GCovDataTimeProfilerRecord: ("time_profiler", True),
+                       GCovDataIntervalRecord: ("interval", True),
+                       GCovDataPow2Record: ("pow2", True),
+                       GCovDatTopnRecord: ("topn", False)}
+
+# Fixed record layouts, without the record header
+FUNCTION_ANNOUNCEMENT_LAYOUT = GcovLayout("3I")
+OBJECT_SUMMARY_LAYOUT = GcovLayout("2I")
+PROGRAM_SUMMARY_LAYOUT = GcovLayout("9I")
+
+
 class GcdaInfo:
     """
         FILE FORMAT:
@@ -177,12 +197,23 @@ class GcdaInfo:
         self.records = records
         self.method_constraint_dict = None
         self.method_block_dict = None
+        # GcdaValidator over method_constraint_dict, created by utils.apply_counters
+        self.validator = None
         self.function_index = None
+        self._mmap = None
+        self.image = None
+        self.image_file = None
+        self.record_offsets = None
+        self.functions = None
         return
 
     def pull_records(self):
         """
         """
+        if isinstance(self.records, GcovLazyRecords):
+            # Lazily loaded records are decoded on access
+            return
+
         record_count = len(self.records)
         rindex = 0
 
@@ -211,7 +242,7 @@ class GcdaInfo:
 
         return record
 
-    def load(self, filename=None, detectEndianess=True):
+    def load(self, filename=None, detectEndianess=True, lazy=False):
         if filename is not None:
             self.filename = filename
             self.file_path = os.path.dirname(filename)
@@ -221,6 +252,11 @@ class GcdaInfo:
         if self.filename is None:
             raise IOError("GCovIO: load 'Filename' not set")
 
+        # The image of an earlier save does not describe the records loaded now
+        self.image = None
+        self.image_file = None
+        self.record_offsets = None
+
         file_handle = None
 
         try:
@@ -229,10 +265,117 @@ class GcdaInfo:
             file_size = os.fstat(file_handle.fileno()).st_size
 
             self._load_file_header(file_handle, detectEndianess)
-            self._load_records(file_handle, file_size)
+            if lazy:
+                self._map_records(file_handle, file_size)
+            else:
+                self._load_records(file_handle, file_size)
         finally:
             if file_handle is not None:
                 file_handle.close()
+
+        self.index_functions()
+        return
+
+    def iter_records(self, filename=None, detectEndianess=True):
+        """
+            Streams the file through a buffered reader one function at a time, without filling
+            self.records.  Yields (ident, records) with the decoded announcement record followed by its
+            counter records.  Records outside of any function are yielded on their own with ident None.
+        """
+        if filename is not None:
+            self.filename = filename
+
+        if self.filename is None:
+            raise IOError("GCovIO: load 'Filename' not set")
+
+        with open(self.filename, 'rb') as file_handle:
+            file_size = os.fstat(file_handle.fileno()).st_size
+
+            self._load_file_header(file_handle, detectEndianess)
+            records = (GcdaInfo.unpack_record(record, self.pack_str32)
+                       for record in self._read_records(file_handle, file_size))
+            yield from GcovIO.group_functions(records)
+
+    def index_functions(self):
+        """
+            Builds the ident -> GcovFunctionEntry index in self.functions.  Only the announcement
+            records are decoded to do so.
+        """
+        if isinstance(self.records, GcovLazyRecords):
+            tags = self.records.tags
+        else:
+            tags = [record.header.tag for record in self.records]
+
+        self.functions = GcovIO.index_functions(tags, self._ident_at)
+        self.function_index = [entry.start for entry in self.functions.values()]
+        return self.functions
+
+    def _ident_at(self, index):
+        record = self.records[index]
+        if isinstance(record, GcdaRecord):
+            ident, _ = GcovIO.unpack_uint32(record.items_data, 0, self.pack_str32)
+            return ident
+        return record.ident
+
+    def get_function_entry(self, ident):
+        if self.functions is None:
+            self.index_functions()
+        return self.functions.get(ident)
+
+    def get_function(self, ident):
+        """
+            Returns the announcement record of function ident, or None if the file has no such function.
+        """
+        entry = self.get_function_entry(ident)
+        if entry is None:
+            return None
+        return self.pull_record_at_index(entry.start)
+
+    def get_counter_record(self, ident):
+        """
+            Returns the GCovDataCounterBaseRecord of function ident, or None.
+        """
+        entry = self.get_function_entry(ident)
+        if entry is None:
+            return None
+        index = entry.first(GcovConst.GCOV_TAG_COUNTER_BASE)
+        if index is None:
+            return None
+        return self.pull_record_at_index(index)
+
+    def get_function_records(self, ident):
+        """
+            Returns the announcement record of function ident followed by all its counter records.
+        """
+        entry = self.get_function_entry(ident)
+        if entry is None:
+            return []
+        return [self.pull_record_at_index(index) for index in range(entry.start, entry.end)]
+
+    def close(self):
+        """
+            Decodes every record still backed by the file mapping, copies out mapped counter payloads
+            and releases the mapping.
+        """
+        if self._mmap is None:
+            return
+
+        records = []
+        for record in self.records:
+            if type(record) in GCDA_COUNTER_FIELDS:
+                field, _ = GCDA_COUNTER_FIELDS[type(record)]
+                values = getattr(record, field)
+                if isinstance(values, memoryview):
+                    setattr(record, field, GcovIO.unpack_uint64_array(values.cast('B'), 0, len(values))[0])
+            records.append(record)
+        self.records = records
+
+        try:
+            self._mmap.close()
+        except BufferError:
+            # A caller still holds a view into the mapping, it is released with the last reference
+            pass
+        self._mmap = None
         return
 
     def save(self, filename=None):
@@ -242,17 +385,87 @@ class GcdaInfo:
         if self.filename is None:
             raise IOError("GCovInfo: save 'Filename' not set")
 
-        try:
-            file_handle = open(self.filename, 'wb')
+        image, offsets = self._serialize_indexed()
 
-            self._save_header(file_handle)
-            self._save_records(file_handle)
-        finally:
-            if file_handle is not None:
-                file_handle.close()
+        # The file is replaced by a rename, so a lazily loaded mapping of the old file stays valid
+        GcovIO.write_file_atomic(self.filename, image)
+
+        # Keep the saved image so save_counters can patch a single function afterwards
+        self.image = image
+        self.image_file = os.path.abspath(self.filename)
+        self.record_offsets = offsets
         # print("Saved %s" % self.filename)
         return
 
+    def save_counters(self, ident, filename=None, atomic=True):
+        """
+            Repacks only the counter record of function ident into the image of the last save.  Every
+            other record is assumed unchanged since then.  Falls back to a full save when there is no
+            saved image of the file or the packed record changes size, e.g. when its counters switch
+            to or from the all-zero negative length encoding.
+
+            With atomic set the patched image replaces the file like save() does, so a reader (gcc, or
+            a --resume after a crash) never sees a half-written gcda; only the repacking is saved.  With
+            atomic unset just the record's bytes are written over the file in place, which is cheaper
+            but safe only when nothing reads the file while it is written.
+        """
+        if filename is not None:
+            self.filename = filename
+
+        if self.filename is None:
+            raise IOError("GCovInfo: save 'Filename' not set")
+
+        entry = self.get_function_entry(ident)
+        index = entry.first(GcovConst.GCOV_TAG_COUNTER_BASE) if entry is not None else None
+
+        file_path = os.path.abspath(self.filename)
+        if self.image is None or self.image_file != file_path or index is None or not os.path.exists(file_path):
+            self.save()
+            return
+
+        record = self.records[index]
+        start = self.record_offsets[index]
+        end = self.record_offsets[index + 1]
+
+        if GcdaInfo.record_size(record) != end - start:
+            self.save()
+            return
+
+        GcdaInfo.pack_record(self.image, start, record, self.pack_str32)
+        if atomic:
+            GcovIO.write_file_atomic(file_path, self.image)
+            return
+        with open(file_path, 'r+b') as file_handle:
+            file_handle.seek(start)
+            file_handle.write(memoryview(self.image)[start: end])
+        return
+
+    def serialize(self):
+        """
+            Packs the file header and every record into one preallocated buffer.
+        """
+        buffer, _ = self._serialize_indexed()
+        return buffer
+
+    def _serialize_indexed(self):
+        records = self.records
+        buffer = bytearray(12 + sum(GcdaInfo.record_size(record) for record in records))
+
+        buffer[0:4] = self.header.magic
+        buffer[4:8] = self.header.version
+        struct.pack_into(self.pack_str32, buffer, 8, self.header.stamp)
+
+        # Byte offset of every record, plus the end of the file
+        offsets = array('Q')
+
+        cpos = 12
+        for record in records:
+            offsets.append(cpos)
+            cpos = GcdaInfo.pack_record(buffer, cpos, record, self.pack_str32)
+        offsets.append(cpos)
+
+        return buffer, offsets
+
     def _load_file_header(self, file_handle, detect_endianess):
         magic = GcovIO.read_quad_char(file_handle)
 
@@ -264,15 +477,17 @@ class GcdaInfo:
                 # print("Little Endian GCDA")
                 self.pack_str32 = GcovConst.PACKUINT32
         version = GcovIO.read_quad_char(file_handle)
-        stamp = GcovIO.read_uint32(file_handle)
+        stamp = GcovIO.read_uint32(file_handle, self.pack_str32)
 
         self.header = GcdaFileHeader(magic, version, stamp)
 
         return
 
     def _load_records(self, file_handle, file_size):
-        self.records = []
+        self.records = list(self._read_records(file_handle, file_size))
+        return
 
+    def _read_records(self, file_handle, file_size):
         cur_pos = file_handle.tell()
 
         while cur_pos < file_size:
@@ -293,34 +508,29 @@ class GcdaInfo:
 
                 break
 
-            nxtRecord = GcdaInfo.read_record(file_handle)
+            nxtRecord = GcdaInfo.read_record(file_handle, self.pack_str32)
 
             if nxtRecord is None:
                 break
 
-            self.records.append(nxtRecord)
+            yield nxtRecord
 
             cur_pos = file_handle.tell()
 
-        return
-
-    def _save_header(self, file_handle):
+    def _map_records(self, file_handle, file_size):
+        self._mmap = mmap.mmap(file_handle.fileno(), 0, access=mmap.ACCESS_READ)
 
-        magic = self.header.magic
-        version = self.header.version
-        stamp = self.header.stamp
+        buffer = memoryview(self._mmap)
+        tags, offsets, lengths = GcovIO.index_records(buffer, file_handle.tell(), file_size, self.pack_str32,
+                                                      GCDA_ZERO_ENCODED_TAGS)
+        pack_str32 = self.pack_str32
 
-        GcovIO.write_quad_char(file_handle, magic)
-        GcovIO.write_quad_char(file_handle, version)
-        GcovIO.write_uint32(file_handle, stamp)
+        def decode(tag, length, items_data):
+            return GcdaInfo.unpack_record(GcdaRecord(tag, length, items_data), pack_str32)
 
+        self.records = GcovLazyRecords(buffer, tags, offsets, lengths, decode)
         return
 
-    def _save_records(self, file_handle):
-
-        for record in self.records:
-            GcdaInfo.write_record(file_handle, record)
-
     @staticmethod
     def read_quad_char(file_handle):
         """
@@ -339,89 +549,51 @@ class GcdaInfo:
         """
         record_tag = GcovIO.read_uint32(file_handle, packStr)
         record_length = GcovIO.read_uint32(file_handle, packStr)
-        # Convert to hexadecimal
-        hex_str = format(record_length, '08X')
-
-        if record_tag == GcovConst.GCOV_TAG_COUNTER_BASE or record_tag == GcovConst.GCOV_TAG_TIME_PROFILER or record_tag == GcovConst.GCOV_TAG_INTERVAL or record_tag == GcovConst.GCOV_TAG_POW2:
-            if hex_str[0] in "89ABCDEF":
-                # If it corresponds to a negative signed integer
-                record_length = abs(int(hex_str, 16) - 2 ** 32)
-                byte_len = record_length * 4
-                record_items_data = b'\x00' * byte_len
-            else:
-                # Otherwise, it's a positive signed integer
-                record_length = int(hex_str, 16)
-                byte_len = record_length * 4
-                record_items_data = file_handle.read(byte_len)
+
+        if record_tag in GCDA_ZERO_ENCODED_TAGS and record_length & 0x80000000:
+            # A negative length marks an all-zero counter record that has no data in the file
+            record_length = 2 ** 32 - record_length
+            record_items_data = bytes(record_length * 4)
         else:
-            record_length = int(hex_str, 16)
-            byte_len = record_length * 4
-            record_items_data = file_handle.read(byte_len)
+            record_items_data = file_handle.read(record_length * 4)
 
         return GcdaRecord(record_tag, record_length, record_items_data)
 
     @staticmethod
-    def write_record(file_handle, record):
+    def write_record(file_handle, record, packStr=GcovConst.PACKUINT32):
         """
             record: header data
             header: uint32:tag uint32:length
               data: item*
         """
-        if isinstance(record, GCovDataProgramSummaryRecord):
-            GcdaInfo.write_program_summary(file_handle, record)
-        elif isinstance(record, GCovDataCounterBaseRecord):
-            GcdaInfo.write_counter_base(file_handle, record)
-        elif isinstance(record, GCovDataIntervalRecord):
-            GcdaInfo.write_interval(file_handle, record)
-        elif isinstance(record, GCovDataPow2Record):
-            GcdaInfo.write_pow2(file_handle, record)
-        elif isinstance(record, GCovDatTopnRecord):
-            GcdaInfo.write_topn(file_handle, record)
-        elif isinstance(record, GCovDataTimeProfilerRecord):
-            GcdaInfo.write_time_profiler(file_handle, record)
-        elif isinstance(record, GCovDataObjectSummaryRecord):
-            GcdaInfo.write_object_summary(file_handle, record)
-        elif isinstance(record, GCovDataFunctionAnnouncementRecord):
-            GcdaInfo.write_function_announcement(file_handle, record)
+        buffer = bytearray(GcdaInfo.record_size(record))
+        GcdaInfo.pack_record(buffer, 0, record, packStr)
+        file_handle.write(buffer)
         return
 
     @staticmethod
-    def unpack_record(record, packStr=GcovConst.PACKUINT32):
-        cpos = 0
+    def record_size(record):
+        """
+            Size in bytes of the packed record, header included.  Unknown record kinds are not written.
+        """
+        return GCDA_CODEC.size(record)
 
-        tag = record.header.tag
-        header = record.header
-        buffer = record.items_data
-
-        if tag == GcovConst.GCOV_TAG_FUNCTION:
-            swap_record = GcdaInfo.unpack_function_announcement(header, buffer, cpos, packStr)
-        elif tag == GcovConst.GCOV_TAG_COUNTER_BASE:
-            swap_record = GcdaInfo.unpack_counter_base(header, buffer, cpos, packStr)
-        elif tag == GcovConst.GCOV_TAG_INTERVAL:
-            swap_record = GcdaInfo.unpack_interval(header, buffer, cpos, packStr)
-        elif tag == GcovConst.GCOV_TAG_POW2:
-            swap_record = GcdaInfo.unpack_pow2(header, buffer, cpos, packStr)
-        elif tag == GcovConst.GCOV_TAG_TOPN:
-            swap_record = GcdaInfo.unpack_topn(header, buffer, cpos, packStr)
-        elif tag == GcovConst.GCOV_TAG_TIME_PROFILER:
-            swap_record = GcdaInfo.unpack_time_profiler(header, buffer, cpos, packStr)
-        elif tag == GcovConst.GCOV_TAG_OBJECT_SUMMARY:
-            swap_record = GcdaInfo.unpack_object_summary(header, buffer, cpos, packStr)
-        elif tag == GcovConst.GCOV_TAG_PROGRAM_SUMMARY:
-            swap_record = GcdaInfo.unpack_program_summary(header, buffer, cpos, packStr)
-        else:
-            raise IOError("Un-recognized tag (0x%x) found at record index in file." % tag)
+    @staticmethod
+    def pack_record(buffer, pos, record, packStr=GcovConst.PACKUINT32):
+        """
+            Packs record into buffer at pos and returns the position after it.
+        """
+        return GCDA_CODEC.pack(buffer, pos, record, packStr)
 
-        return swap_record
+    @staticmethod
+    def unpack_record(record, packStr=GcovConst.PACKUINT32):
+        return GCDA_CODEC.decode(record.header, record.items_data, 0, packStr)
 
     @staticmethod
     def unpack_object_summary(header, buffer, pos, packStr=GcovConst.PACKUINT32):
         """
         """
-        cpos = pos
-
-        runs, cpos = GcovIO.unpack_uint32(buffer, cpos, packStr)
-        summax, cpos = GcovIO.unpack_uint32(buffer, cpos, packStr)
+        runs, summax = OBJECT_SUMMARY_LAYOUT.get(packStr).unpack_from(buffer, pos)
 
         rval = GCovDataObjectSummaryRecord(header, runs, summax)
 
@@ -431,37 +603,48 @@ class GcdaInfo:
     def unpack_program_summary(header, buffer, pos, packStr=GcovConst.PACKUINT32):
         """
         """
-        cpos = pos
+        checksum, counts, runs, sum_all_low, sum_all_high, run_max_low, run_max_high, sum_max_low, sum_max_high = \
+            PROGRAM_SUMMARY_LAYOUT.get(packStr).unpack_from(buffer, pos)
 
-        checksum, cpos = GcovIO.unpack_uint32(buffer, cpos, packStr)
-        counts, cpos = GcovIO.unpack_uint32(buffer, cpos, packStr)
-        runs, cpos = GcovIO.unpack_uint32(buffer, cpos, packStr)
-        sum_all, cpos = GcovIO.unpack_uint64(buffer, cpos, packStr)
-        run_max, cpos = GcovIO.unpack_uint64(buffer, cpos, packStr)
-        sum_max, cpos = GcovIO.unpack_uint64(buffer, cpos, packStr)
-
-        rval = GCovDataProgramSummaryRecord(header, checksum, counts, runs, sum_all, run_max, sum_max)
+        rval = GCovDataProgramSummaryRecord(header, checksum, counts, runs, (sum_all_high << 32) | sum_all_low,
+                                            (run_max_high << 32) | run_max_low, (sum_max_high << 32) | sum_max_low)
 
         return rval
 
     @staticmethod
-    def unpack_counter_base(header, buffer, pos, packStr=GcovConst.PACKUINT32):
+    def unpack_counters(header, buffer, pos, packStr=GcovConst.PACKUINT32):
         """
-            announce_function: header uint32:ident uint32:checksum string:name string:source uint32:lineno
+            counters: header uint64:count*
+
+            Shared bulk decoder for every counter record kind, header.length is in 4 byte words.  A
+            memoryview buffer (lazy load) yields a zero-copy view instead of an array('Q').
         """
-        cpos = pos
+        counters, _ = GcovIO.unpack_uint64_view(buffer, pos, header.length // 2, packStr)
+        return counters
 
-        counterLength = header.length / 2
-        counterIndex = 0
+    @staticmethod
+    def pack_counters(buffer, pos, header, counters, packStr=GcovConst.PACKUINT32, encode_zero=True):
+        """
+            counters: header uint64:count*
 
-        counters = []
+            An all-zero counter record is stored as a negative length and no data when encode_zero is set.
+        """
+        if encode_zero and len(counters) != 0 and not any(counters):
+            RECORD_HEADER_LAYOUT.get(packStr).pack_into(buffer, pos, header.tag, -header.length + 2 ** 32)
+            return pos + 8
+
+        RECORD_HEADER_LAYOUT.get(packStr).pack_into(buffer, pos, header.tag, header.length)
+        cpos = pos + 8
+        data = GcovIO.pack_uint64_array(counters, packStr)
+        buffer[cpos: cpos + len(data)] = data
+        return cpos + len(data)
 
-        while counterIndex < counterLength:
-            nextValue, cpos = GcovIO.unpack_uint64(buffer, cpos, packStr)
-            if nextValue == 386547056640:
-                pass
-            counters.append(nextValue)
-            counterIndex += 1
+    @staticmethod
+    def unpack_counter_base(header, buffer, pos, packStr=GcovConst.PACKUINT32):
+        """
+            counter_base: header uint64:count*
+        """
+        counters = GcdaInfo.unpack_counters(header, buffer, pos, packStr)
 
         rval = GCovDataCounterBaseRecord(header, counters)
 
@@ -472,11 +655,7 @@ class GcdaInfo:
         """
             announce_function: header uint32:ident uint32:checksum string:name string:source uint32:lineno
         """
-        cpos = pos
-        ident, cpos = GcovIO.unpack_uint32(buffer, cpos, packStr)
-        lineno_checksum, cpos = GcovIO.unpack_uint32(buffer, cpos, packStr)
-
-        cfg_checksum, cpos = GcovIO.unpack_uint32(buffer, cpos, packStr)
+        ident, lineno_checksum, cfg_checksum = FUNCTION_ANNOUNCEMENT_LAYOUT.get(packStr).unpack_from(buffer, pos)
 
         rval = GCovDataFunctionAnnouncementRecord(header, ident, lineno_checksum, cfg_checksum)
 
@@ -484,115 +663,44 @@ class GcdaInfo:
 
     @classmethod
     def unpack_time_profiler(cls, header, buffer, pos, packStr):
-        cpos = pos
-
-        counterLength = header.length / 2
-        counterIndex = 0
-
-        counters = []
-
-        while counterIndex < counterLength:
-            nextValue, cpos = GcovIO.unpack_uint64(buffer, cpos, packStr)
-            if nextValue == 386547056640:
-                pass
-            counters.append(nextValue)
-            counterIndex += 1
+        counters = GcdaInfo.unpack_counters(header, buffer, pos, packStr)
 
         rval = GCovDataTimeProfilerRecord(header, counters)
 
         return rval
 
     @classmethod
-    def write_program_summary(cls, file_handle, record):
+    def pack_program_summary(cls, buffer, pos, record, packStr=GcovConst.PACKUINT32):
         header = record.header
-        checksum = record.check_sum
-        counts = record.counts
-        runs = record.runs
-        sum_all = record.sum_all
-        run_max = record.run_max
-        sum_max = record.sum_max
-
-        GcovIO.write_uint32(file_handle, header.tag)
-        GcovIO.write_uint32(file_handle, header.length)
-        GcovIO.write_uint32(file_handle, checksum)
-        GcovIO.write_uint32(file_handle, counts)
-        GcovIO.write_uint32(file_handle, runs)
-        GcovIO.write_uint64(file_handle, sum_all)
-        GcovIO.write_uint64(file_handle, run_max)
-        GcovIO.write_uint64(file_handle, sum_max)
+        low = GcovConst.LOWORDERMASK
 
-        return
+        RECORD_HEADER_LAYOUT.get(packStr).pack_into(buffer, pos, header.tag, header.length)
+        PROGRAM_SUMMARY_LAYOUT.get(packStr).pack_into(buffer, pos + 8, record.check_sum, record.counts, record.runs,
+                                                      record.sum_all & low, record.sum_all >> 32,
+                                                      record.run_max & low, record.run_max >> 32,
+                                                      record.sum_max & low, record.sum_max >> 32)
+        return pos + 8 + PROGRAM_SUMMARY_LAYOUT.size
 
     @classmethod
-    def write_counter_base(cls, file_handle, record):
+    def pack_object_summary(cls, buffer, pos, record, packStr=GcovConst.PACKUINT32):
         header = record.header
-        counters = record.counters
-        if len(counters) != 0 and all(x == 0 for x in counters):
-            GcovIO.write_uint32(file_handle, header.tag)
-            GcovIO.write_uint32(file_handle, -header.length + 2 ** 32)
-        else:
-            GcovIO.write_uint32(file_handle, header.tag)
-            GcovIO.write_uint32(file_handle, header.length)
-            for counter in counters:
-                GcovIO.write_uint64(file_handle, counter)
-        return
 
-    @classmethod
-    def write_time_profiler(cls, file_handle, record):
-        header = record.header
-        time_profiler = record.time_profiler
-
-        if all(x == 0 for x in time_profiler):
-            GcovIO.write_uint32(file_handle, header.tag)
-            GcovIO.write_uint32(file_handle, -header.length + 2 ** 32)
-        else:
-            GcovIO.write_uint32(file_handle, header.tag)
-            GcovIO.write_uint32(file_handle, header.length)
-            for counter in time_profiler:
-                GcovIO.write_uint64(file_handle, counter)
-        return
+        RECORD_HEADER_LAYOUT.get(packStr).pack_into(buffer, pos, header.tag, header.length)
+        OBJECT_SUMMARY_LAYOUT.get(packStr).pack_into(buffer, pos + 8, record.runs, record.sum_max)
+        return pos + 8 + OBJECT_SUMMARY_LAYOUT.size
 
     @classmethod
-    def write_object_summary(cls, file_handle, record):
+    def pack_function_announcement(cls, buffer, pos, record, packStr=GcovConst.PACKUINT32):
         header = record.header
-        runs = record.runs
-        summax = record.sum_max
 
-        GcovIO.write_uint32(file_handle, header.tag)
-        GcovIO.write_uint32(file_handle, header.length)
-        GcovIO.write_uint32(file_handle, runs)
-        GcovIO.write_uint32(file_handle, summax)
-        return
-
-    @classmethod
-    def write_function_announcement(cls, file_handle, record):
-        header = record.header
-        indent = record.ident
-        lineno_checksum = record.lineno_checksum
-        cfg_checksum = record.cfg_checksum
-
-        GcovIO.write_uint32(file_handle, header.tag)
-        GcovIO.write_uint32(file_handle, header.length)
-        GcovIO.write_uint32(file_handle, indent)
-        GcovIO.write_uint32(file_handle, lineno_checksum)
-        GcovIO.write_uint32(file_handle, cfg_checksum)
-        return
+        RECORD_HEADER_LAYOUT.get(packStr).pack_into(buffer, pos, header.tag, header.length)
+        FUNCTION_ANNOUNCEMENT_LAYOUT.get(packStr).pack_into(buffer, pos + 8, record.ident, record.lineno_checksum,
+                                                            record.cfg_checksum)
+        return pos + 8 + FUNCTION_ANNOUNCEMENT_LAYOUT.size
 
     @classmethod
     def unpack_interval(cls, header, buffer, pos, packStr):
-        cpos = pos
-
-        counterLength = header.length / 2
-        counterIndex = 0
-
-        counters = []
-
-        while counterIndex < counterLength:
-            nextValue, cpos = GcovIO.unpack_uint64(buffer, cpos, packStr)
-            if nextValue == 386547056640:
-                pass
-            counters.append(nextValue)
-            counterIndex += 1
+        counters = GcdaInfo.unpack_counters(header, buffer, pos, packStr)
 
         rval = GCovDataIntervalRecord(header, counters)
 
@@ -600,19 +708,7 @@ class GcdaInfo:
 
     @classmethod
     def unpack_pow2(cls, header, buffer, pos, packStr):
-        cpos = pos
-
-        counterLength = header.length / 2
-        counterIndex = 0
-
-        counters = []
-
-        while counterIndex < counterLength:
-            nextValue, cpos = GcovIO.unpack_uint64(buffer, cpos, packStr)
-            if nextValue == 386547056640:
-                pass
-            counters.append(nextValue)
-            counterIndex += 1
+        counters = GcdaInfo.unpack_counters(header, buffer, pos, packStr)
 
         rval = GCovDataPow2Record(header, counters)
 
@@ -620,60 +716,38 @@ class GcdaInfo:
 
     @classmethod
     def unpack_topn(cls, header, buffer, pos, packStr):
-        cpos = pos
-
-        counterLength = header.length / 2
-        counterIndex = 0
-
-        counters = []
-
-        while counterIndex < counterLength:
-            nextValue, cpos = GcovIO.unpack_uint64(buffer, cpos, packStr)
-            if nextValue == 386547056640:
-                pass
-            counters.append(nextValue)
-            counterIndex += 1
+        counters = GcdaInfo.unpack_counters(header, buffer, pos, packStr)
 
         rval = GCovDatTopnRecord(header, counters)
 
         return rval
 
-    @classmethod
-    def write_interval(cls, file_handle, record):
-        header = record.header
-        interval = record.interval
 
-        if len(interval) != 0 and all(x == 0 for x in interval):
-            GcovIO.write_uint32(file_handle, header.tag)
-            GcovIO.write_uint32(file_handle, -header.length + 2 ** 32)
-        else:
-            GcovIO.write_uint32(file_handle, header.tag)
-            GcovIO.write_uint32(file_handle, header.length)
-            for counter in interval:
-                GcovIO.write_uint64(file_handle, counter)
-        return
+def _register_counters(tag, record_type, decode):
+    field, encode_zero = GCDA_COUNTER_FIELDS[record_type]
 
-    @classmethod
-    def write_pow2(cls, file_handle, record):
-        header = record.header
-        pow2 = record.pow2
+    def size(record):
+        counters = getattr(record, field)
+        if encode_zero and len(counters) != 0 and not any(counters):
+            return 8
+        return 8 + len(counters) * 8
 
-        if len(pow2) != 0 and all(x == 0 for x in pow2):
-            GcovIO.write_uint32(file_handle, header.tag)
-            GcovIO.write_uint32(file_handle, -header.length + 2 ** 32)
-        else:
-            GcovIO.write_uint32(file_handle, header.tag)
-            GcovIO.write_uint32(file_handle, header.length)
-            for counter in pow2:
-                GcovIO.write_uint64(file_handle, counter)
-        return
+    def pack(buffer, pos, record, packStr):
+        return GcdaInfo.pack_counters(buffer, pos, record.header, getattr(record, field), packStr, encode_zero)
+
+    GCDA_CODEC.register(tag, record_type, decode, pack, size)
 
-    @classmethod
-    def write_topn(cls, file_handle, record):
-        header = record.header
-        topn = record.topn
 
-        GcovIO.write_uint32(file_handle, header.tag)
-        GcovIO.write_uint32(file_handle, header.length)
-        for counter in topn:
-            GcovIO.write_uint64(file_handle, counter)
+GCDA_CODEC = GcovRecordCodec("gcda")
+GCDA_CODEC.register(GcovConst.GCOV_TAG_FUNCTION, GCovDataFunctionAnnouncementRecord,
+                    GcdaInfo.unpack_function_announcement, GcdaInfo.pack_function_announcement,
+                    8 + FUNCTION_ANNOUNCEMENT_LAYOUT.size)
+GCDA_CODEC.register(GcovConst.GCOV_TAG_OBJECT_SUMMARY, GCovDataObjectSummaryRecord,
+                    GcdaInfo.unpack_object_summary, GcdaInfo.pack_object_summary, 8 + OBJECT_SUMMARY_LAYOUT.size)
+GCDA_CODEC.register(GcovConst.GCOV_TAG_PROGRAM_SUMMARY, GCovDataProgramSummaryRecord,
+                    GcdaInfo.unpack_program_summary, GcdaInfo.pack_program_summary, 8 + PROGRAM_SUMMARY_LAYOUT.size)
+_register_counters(GcovConst.GCOV_TAG_COUNTER_BASE, GCovDataCounterBaseRecord, GcdaInfo.unpack_counter_base)
+_register_counters(GcovConst.GCOV_TAG_TIME_PROFILER, GCovDataTimeProfilerRecord, GcdaInfo.unpack_time_profiler)
+_register_counters(GcovConst.GCOV_TAG_INTERVAL, GCovDataIntervalRecord, GcdaInfo.unpack_interval)
+_register_counters(GcovConst.GCOV_TAG_POW2, GCovDataPow2Record, GcdaInfo.unpack_pow2)
+_register_counters(GcovConst.GCOV_TAG_TOPN, GCovDatTopnRecord, GcdaInfo.unpack_topn)
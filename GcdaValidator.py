@@ -0,0 +1,121 @@
+import struct
+
+from GcdaInfo import GcdaInfo, GCDA_COUNTER_FIELDS, GCDA_ZERO_ENCODED_TAGS
+
+
+class GcdaValidator:
+    """
+        In-process check of a (mutated) GcdaInfo against the constraint skeletons parsed from its gcno,
+        run before a mutant is compiled so that gcc never sees profile data it would reject.
+
+        == Checks per function ==
+        announcement   the gcda announces the function and its lineno/cfg checksums match the gcno
+        counter count  the counter record has one counter per instrumented arc
+        range          every counter fits an UInt64
+        encoding       the record packs to the bytes gcc reads: tag, then a negative length and no data for
+                       all-zero counters, else length 2 * count and every counter as low and high word
+        flow           arc flows rebuilt from the counters are non-negative and conserved at every block
+    """
+
+    def __init__(self, gcda, method_constraint_dict=None):
+        self.gcda = gcda
+        self.method_constraint_dict = (method_constraint_dict if method_constraint_dict is not None
+                                       else gcda.method_constraint_dict)
+        return
+
+    def validate(self, idents=None):
+        """
+            Returns a list of problem descriptions for idents (every function when None), empty when valid.
+        """
+        problems = []
+        if idents is None:
+            idents = self.method_constraint_dict
+            problems.extend("function %d: not in the gcno" % ident
+                            for ident in self.gcda.functions if ident not in self.method_constraint_dict)
+        for ident in idents:
+            problems.extend(self.validate_function(ident))
+        return problems
+
+    def validate_function(self, ident):
+        constraint = self.method_constraint_dict.get(ident)
+        if constraint is None:
+            return ["function %d: not in the gcno" % ident]
+        announcement = self.gcda.get_function(ident)
+        if announcement is None:
+            return ["function %d: not announced in the gcda" % ident]
+
+        problems = []
+        for field in ("lineno_checksum", "cfg_checksum"):
+            expected = getattr(constraint, field)
+            if expected is not None and getattr(announcement, field) != expected:
+                problems.append("function %d: %s %#x, gcno has %#x" % (ident, field, getattr(announcement, field),
+                                                                       expected))
+
+        record = self.gcda.get_counter_record(ident)
+        if record is None:
+            if constraint.counter_list:
+                problems.append("function %d: no counter record" % ident)
+            return problems
+
+        counters = record.counters
+        if len(counters) != len(constraint.counter_list):
+            problems.append("function %d: %d counters for %d instrumented arcs" % (ident, len(counters),
+                                                                                   len(constraint.counter_list)))
+            return problems
+        if any(counter < 0 or counter >= 2 ** 64 for counter in counters):
+            problems.append("function %d: counter out of UInt64 range" % ident)
+            return problems
+
+        problems.extend(self.check_encoding(ident, record))
+        problems.extend(self.check_flow(ident, constraint, counters))
+        return problems
+
+    def check_encoding(self, ident, record):
+        """
+            Packs the record the way save() and save_counters() write it and compares the bytes with the layout
+            built here from the counters with struct alone.
+        """
+        buffer = bytearray(GcdaInfo.record_size(record))
+        end = GcdaInfo.pack_record(buffer, 0, record, self.gcda.pack_str32)
+        expected = self.expected_bytes(record)
+        if end != len(buffer) or buffer != expected:
+            if len(buffer) < 8:
+                return ["function %d: counter record packs to %d bytes" % (ident, len(buffer))]
+            tag, length = struct.unpack_from(self.gcda.pack_str32[0] + "II", buffer, 0)
+            expected_tag, expected_length = struct.unpack_from(self.gcda.pack_str32[0] + "II", expected, 0)
+            if (tag, length, len(buffer)) != (expected_tag, expected_length, len(expected)):
+                return ["function %d: counter record packs as tag %#x length %#x in %d bytes, expected tag %#x "
+                        "length %#x in %d bytes" % (ident, tag, length, len(buffer), expected_tag,
+                                                    expected_length, len(expected))]
+            return ["function %d: counter record payload does not encode its counters" % ident]
+        return []
+
+    def expected_bytes(self, record):
+        order = self.gcda.pack_str32[0]
+        field, encode_zero = GCDA_COUNTER_FIELDS[type(record)]
+        counters = getattr(record, field)
+        tag = record.header.tag
+        if encode_zero and tag in GCDA_ZERO_ENCODED_TAGS and len(counters) and not any(counters):
+            return struct.pack(order + "II", tag, 2 ** 32 - 2 * len(counters))
+        words = [word for counter in counters for word in (counter & 0xffffffff, counter >> 32)]
+        return struct.pack(order + "%dI" % (len(words) + 2), tag, len(words), *words)
+
+    @staticmethod
+    def check_flow(ident, constraint, counters):
+        sampler = constraint.flow_sampler()
+        flows = sampler.arc_flows(counters, complete=False)
+        if flows is None:
+            return ["function %d: counters imply a negative arc flow" % ident]
+
+        # equations holds the arc positions of constraint.constraints, built once per function
+        for block_constraint, (incoming_positions, outgoing_positions) in zip(constraint.constraints,
+                                                                              sampler.equations):
+            incoming = [flows[position] for position in incoming_positions]
+            outgoing = [flows[position] for position in outgoing_positions]
+            if None in incoming or None in outgoing:
+                continue
+            if sum(incoming) != sum(outgoing):
+                block = block_constraint.outgoing_edge[0].source_block_number
+                return ["function %d: block %d has incoming flow %d and outgoing flow %d" % (
+                    ident, block, sum(incoming), sum(outgoing))]
+        return []
@@ -0,0 +1,160 @@
+import hashlib
+import os
+import struct
+import sys
+from array import array
+
+from GcnoInfo import GcovGraphArc
+from GcovConstraint import GcovConstraint, Constraint
+from GcovIO import GcovIO
+
+# Bump whenever GcnoInfo parsing or GcovConstraint construction changes what ends up in the cache
+PARSER_VERSION = 3
+
+CACHE_FILE_MAGIC = b'pfgc'
+CACHE_DIR_ENV = "PROFILEFUZZ_CACHE"
+
+
+class GcnoCache:
+    """
+        Content addressed cache of the per-function CFG skeletons built from a gcno file.
+
+        The key is the sha256 of the parser version and the gcno bytes, so the same program compiled again
+        (another run or another -O level with an identical gcno) skips parsing and constraint construction.
+
+        == File ==
+        [Magic] + [Version(UInt32)] + [FunctionCount(UInt32)] + [Function*]
+
+        == Function ==
+        [Ident] [BlockCount] [LinenoChecksum] [CfgChecksum]
+        [ArcCount] [Source Destination Flag]*
+        [CounterCount] [ArcIndex]*
+        [LineBlockCount] [BlockNumber]*
+        [ConstraintCount] ([IncomingCount] [ArcIndex]* [OutgoingCount] [ArcIndex]*)*
+
+        Every item is a little-endian UInt32.
+    """
+
+    def __init__(self, cache_dir=None):
+        if cache_dir is None:
+            cache_dir = os.environ.get(CACHE_DIR_ENV,
+                                       os.path.join(os.path.expanduser("~"), ".cache", "profilefuzz"))
+        self.cache_dir = cache_dir
+        return
+
+    @staticmethod
+    def cache_key(gcno_file_name, chunk_size=1 << 20):
+        digest = hashlib.sha256(struct.pack("<I", PARSER_VERSION))
+        with open(gcno_file_name, 'rb') as file_handle:
+            for chunk in iter(lambda: file_handle.read(chunk_size), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def cache_path(self, key):
+        return os.path.join(self.cache_dir, key + ".bin")
+
+    def load(self, key):
+        """
+            Returns (method_constraint_dict, method_block_dict) for key, or None on a miss.  A truncated or
+            malformed entry is a miss too.
+        """
+        try:
+            with open(self.cache_path(key), 'rb') as file_handle:
+                data = file_handle.read()
+        except OSError:
+            return None
+
+        if len(data) < 12 or data[0:4] != CACHE_FILE_MAGIC:
+            return None
+        version, function_count = struct.unpack_from("<II", data, 4)
+        if version != PARSER_VERSION:
+            return None
+
+        try:
+            words = array('I')
+            words.frombytes(data[12:])
+            if sys.byteorder != 'little':
+                words.byteswap()
+            return GcnoCache.decode(words, function_count)
+        except (ValueError, IndexError, struct.error):
+            return None
+
+    def save(self, key, method_constraint_dict, method_block_dict):
+        words = GcnoCache.encode(method_constraint_dict, method_block_dict)
+        if sys.byteorder != 'little':
+            words.byteswap()
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        buffer = CACHE_FILE_MAGIC + struct.pack("<II", PARSER_VERSION, len(method_constraint_dict)) + words.tobytes()
+        GcovIO.write_file_atomic(self.cache_path(key), buffer)
+        return
+
+    @staticmethod
+    def encode(method_constraint_dict, method_block_dict):
+        words = array('I')
+
+        for ident, constraint in method_constraint_dict.items():
+            arc_position = {id(arc): position for position, arc in enumerate(constraint.arc_list)}
+
+            words.append(ident)
+            words.append(method_block_dict.get(ident, 0))
+            words.append(constraint.lineno_checksum or 0)
+            words.append(constraint.cfg_checksum or 0)
+
+            words.append(len(constraint.arc_list))
+            for arc in constraint.arc_list:
+                words.extend((arc.source_block_number, arc.destination_block_number, arc.flag))
+
+            words.append(len(constraint.counter_list))
+            words.extend(arc_position[id(arc)] for arc in constraint.counter_list)
+
+            words.append(len(constraint.block_list))
+            words.extend(constraint.block_list)
+
+            words.append(len(constraint.constraints))
+            for block_constraint in constraint.constraints:
+                words.append(len(block_constraint.incoming_edge))
+                words.extend(arc_position[id(arc)] for arc in block_constraint.incoming_edge)
+                words.append(len(block_constraint.outgoing_edge))
+                words.extend(arc_position[id(arc)] for arc in block_constraint.outgoing_edge)
+
+        return words
+
+    @staticmethod
+    def decode(words, function_count):
+        method_constraint_dict = {}
+        method_block_dict = {}
+        cpos = 0
+
+        def take(count):
+            nonlocal cpos
+            items = words[cpos: cpos + count]
+            cpos += count
+            return items
+
+        for _ in range(function_count):
+            ident, block_count, lineno_checksum, cfg_checksum, arc_count = take(5)
+
+            arc_words = take(arc_count * 3)
+            arc_list = [GcovGraphArc(arc_words[i], arc_words[i + 1], arc_words[i + 2])
+                        for i in range(0, len(arc_words), 3)]
+
+            constraint = GcovConstraint(ident, [])
+            constraint.lineno_checksum = lineno_checksum
+            constraint.cfg_checksum = cfg_checksum
+            constraint.arc_list = arc_list
+            constraint.counter_list = [arc_list[i] for i in take(take(1)[0])]
+            constraint.block_list = list(take(take(1)[0]))
+
+            constraint_count, = take(1)
+            for _ in range(constraint_count):
+                incoming_edge = [arc_list[i] for i in take(take(1)[0])]
+                outgoing_edge = [arc_list[i] for i in take(take(1)[0])]
+                constraint.constraints.append(Constraint(incoming_edge, outgoing_edge))
+
+            method_constraint_dict[ident] = constraint
+            method_block_dict[ident] = block_count
+
+        if cpos != len(words):
+            raise ValueError("GcnoCache: entry has %d words, decoding used %d" % (len(words), cpos))
+        return method_constraint_dict, method_block_dict
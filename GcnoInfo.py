@@ -1,6 +1,7 @@
+import mmap
 import os
 import GcovConst
-from GcovIO import GcovIO
+from GcovIO import GcovIO, GcovLazyRecords, GcovLayout, GcovRecordCodec
 
 
 class GcnoInfo:
@@ -11,9 +12,11 @@ class GcnoInfo:
         self.filename = filename
         self.header = header
         self.records = records
+        self.functions = None
+        self._mmap = None
         return
 
-    def load(self, filename=None, detectEndianess=True):
+    def load(self, filename=None, detectEndianess=True, lazy=False):
         if filename is not None:
             self.filename = filename
             self.file_path = os.path.dirname(filename)
@@ -30,34 +33,129 @@ class GcnoInfo:
             file_size = os.fstat(file_handle.fileno()).st_size
 
             self._load_file_header(file_handle, detectEndianess)
-            self._load_records(file_handle, file_size)
+            if lazy:
+                self._map_records(file_handle, file_size)
+            else:
+                self._load_records(file_handle, file_size)
         finally:
             if file_handle is not None:
                 file_handle.close()
+
+        self.index_functions()
+        return
+
+    def iter_records(self, filename=None, detectEndianess=True):
+        """
+            Streams the file through a buffered reader one function at a time, without filling
+            self.records.  Yields (ident, records) with the decoded announcement record followed by its
+            block, arc and line records.  Records outside of any function are yielded on their own with
+            ident None.
+        """
+        if filename is not None:
+            self.filename = filename
+
+        if self.filename is None:
+            raise IOError("GCovIO: load 'Filename' not set")
+
+        with open(self.filename, 'rb') as file_handle:
+            file_size = os.fstat(file_handle.fileno()).st_size
+
+            self._load_file_header(file_handle, detectEndianess)
+            records = (GcnoInfo.unpack_record(record, self.pack_str32)
+                       for record in self._read_records(file_handle, file_size))
+            yield from GcovIO.group_functions(records)
+
+    def index_functions(self):
+        """
+            Builds the ident -> GcovFunctionEntry index in self.functions.  Only the announcement
+            records are decoded to do so.
+        """
+        if isinstance(self.records, GcovLazyRecords):
+            tags = self.records.tags
+        else:
+            tags = [record.header.tag for record in self.records]
+
+        self.functions = GcovIO.index_functions(tags, self._ident_at)
+        return self.functions
+
+    def _ident_at(self, index):
+        record = self.records[index]
+        if isinstance(record, GcnoRecord):
+            ident, _ = GcovIO.unpack_uint32(record.items_data, 0, self.pack_str32)
+            return ident
+        return record.ident
+
+    def get_function_entry(self, ident):
+        if self.functions is None:
+            self.index_functions()
+        return self.functions.get(ident)
+
+    def get_function(self, ident):
+        """
+            Returns the announcement record of function ident, or None if the file has no such function.
+        """
+        entry = self.get_function_entry(ident)
+        if entry is None:
+            return None
+        return self.pull_record_at_index(entry.start)
+
+    def get_function_records(self, ident):
+        """
+            Returns the announcement record of function ident followed by its block, arc and line records.
+        """
+        entry = self.get_function_entry(ident)
+        if entry is None:
+            return []
+        return [self.pull_record_at_index(index) for index in range(entry.start, entry.end)]
+
+    def get_block_count(self, ident):
+        entry = self.get_function_entry(ident)
+        index = entry.first(GcovConst.GCOV_TAG_BLOCKS) if entry is not None else None
+        if index is None:
+            return 0
+        return self.pull_record_at_index(index).block_count
+
+    def close(self):
+        """
+            Decodes every record still backed by the file mapping and releases the mapping.
+        """
+        if self._mmap is None:
+            return
+
+        self.records = list(self.records)
+
+        try:
+            self._mmap.close()
+        except BufferError:
+            # A caller still holds a view into the mapping, it is released with the last reference
+            pass
+        self._mmap = None
         return
 
     def _load_file_header(self, file_handle, detect_endianess):
         magic = GcovIO.read_quad_char(file_handle)
 
         if detect_endianess:
-            if magic == GcovConst.GCDA_FILE_MAGIC_BIGENDIAN:
-                # print("Big Endian GCDA")
+            if magic == GcovConst.GCNO_FILE_MAGIC_BIGENDIAN:
+                # print("Big Endian GCNO")
                 self.pack_str32 = GcovConst.PACKUINT32_BIGENDIAN
-            elif magic == GcovConst.GCDA_FILE_MAGIC:
-                # print("Little Endian GCDA")
+            elif magic == GcovConst.GCNO_FILE_MAGIC:
+                # print("Little Endian GCNO")
                 self.pack_str32 = GcovConst.PACKUINT32
         version = GcovIO.read_quad_char(file_handle)
-        stamp = GcovIO.read_uint32(file_handle)
-        cwd_length = GcovIO.read_uint32(file_handle)
+        stamp = GcovIO.read_uint32(file_handle, self.pack_str32)
+        cwd_length = GcovIO.read_uint32(file_handle, self.pack_str32)
         cwd = file_handle.read(cwd_length * 4)
-        unexc_blocks = GcovIO.read_uint32(file_handle)
+        unexc_blocks = GcovIO.read_uint32(file_handle, self.pack_str32)
         self.header = GcnoFileHeader(magic, version, stamp, cwd, unexc_blocks)
 
         return
 
     def _load_records(self, file_handle, file_size):
-        self.records = []
+        self.records = list(self._read_records(file_handle, file_size))
+        return
 
+    def _read_records(self, file_handle, file_size):
         cur_pos = file_handle.tell()
 
         while cur_pos < file_size:
@@ -78,20 +176,35 @@ class GcnoInfo:
 
                 break
 
-            nxtRecord = GcnoInfo.read_record(file_handle)
+            nxtRecord = GcnoInfo.read_record(file_handle, self.pack_str32)
 
             if nxtRecord is None:
                 break
 
-            self.records.append(nxtRecord)
+            yield nxtRecord
 
             cur_pos = file_handle.tell()
 
+    def _map_records(self, file_handle, file_size):
+        self._mmap = mmap.mmap(file_handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+        buffer = memoryview(self._mmap)
+        tags, offsets, lengths = GcovIO.index_records(buffer, file_handle.tell(), file_size, self.pack_str32)
+        pack_str32 = self.pack_str32
+
+        def decode(tag, length, items_data):
+            return GcnoInfo.unpack_record(GcnoRecord(tag, length, items_data), pack_str32)
+
+        self.records = GcovLazyRecords(buffer, tags, offsets, lengths, decode)
         return
 
     def pull_records(self):
         """
         """
+        if isinstance(self.records, GcovLazyRecords):
+            # Lazily loaded records are decoded on access
+            return
+
         record_count = len(self.records)
         rindex = 0
 
@@ -122,43 +235,22 @@ class GcnoInfo:
 
     @staticmethod
     def unpack_record(record, packStr=GcovConst.PACKUINT32):
-        cpos = 0
-
-        tag = record.header.tag
-        header = record.header
-        buffer = record.items_data
-
-        if tag == GcovConst.GCOV_TAG_FUNCTION:
-            swap_record = GcnoInfo.unpack_function_announcement(header, buffer, cpos, packStr)
-        elif tag == GcovConst.GCOV_TAG_ARCS:
-            swap_record = GcnoInfo.unpack_arc_set(header, buffer, cpos, packStr)
-        elif tag == GcovConst.GCOV_TAG_LINES:
-            swap_record = GcnoInfo.unpack_line_set(header, buffer, cpos, packStr)
-        elif tag == GcovConst.GCOV_TAG_BLOCKS:
-            swap_record = GcnoInfo.unpack_basic_block(header, buffer, cpos, packStr)
-        else:
-            raise IOError("Un-recognized tag (0x%x) found in file." % (tag))
-
-        return swap_record
+        return GCNO_CODEC.decode(record.header, record.items_data, 0, packStr)
 
     @staticmethod
     def unpack_function_announcement(header, buffer, pos, packStr=GcovConst.PACKUINT32):
         """
             announce_function: header uint32:ident uint32:checksum string:name string:source uint32:lineno
         """
-        cpos = pos
-        ident, cpos = GcovIO.unpack_uint32(buffer, cpos, packStr)
-        lineno_checksum, cpos = GcovIO.unpack_uint32(buffer, cpos, packStr)
-        cfg_checksum, cpos = GcovIO.unpack_uint32(buffer, cpos, packStr)
-        function_name_length, cpos = GcovIO.unpack_uint32(buffer, cpos, packStr)
+        ident, lineno_checksum, cfg_checksum, function_name_length = \
+            FUNCTION_ANNOUNCEMENT_LAYOUT.get(packStr).unpack_from(buffer, pos)
+        cpos = pos + FUNCTION_ANNOUNCEMENT_LAYOUT.size
         function_name, cpos = GcovIO.unpack_string(buffer, cpos, function_name_length)
         artificial, cpos = GcovIO.unpack_uint32(buffer, cpos, packStr)
         source_length, cpos = GcovIO.unpack_uint32(buffer, cpos, packStr)
         source, cpos = GcovIO.unpack_string(buffer, cpos, source_length)
-        start_lineno, cpos = GcovIO.unpack_uint32(buffer, cpos, packStr)
-        start_columnno, cpos = GcovIO.unpack_uint32(buffer, cpos, packStr)
-        end_lineno, cpos = GcovIO.unpack_uint32(buffer, cpos, packStr)
-        end_columnno, cpos = GcovIO.unpack_uint32(buffer, cpos, packStr)
+        start_lineno, start_columnno, end_lineno, end_columnno = \
+            FUNCTION_LOCATION_LAYOUT.get(packStr).unpack_from(buffer, cpos)
 
         rval = GcovNoteFunctionAnnouncementRecord(header, ident, lineno_checksum, cfg_checksum, function_name,
                                                   artificial,
@@ -194,19 +286,10 @@ class GcnoInfo:
 
         blockNumber, cpos = GcovIO.unpack_uint32(buffer, cpos, packStr)
 
-        arcCount = int((header.length - 1) / 2)
-        arcSet = []
-
-        while arcCount > 0:
-            destblock, cpos = GcovIO.unpack_uint32(buffer, cpos, packStr)
-            flags, cpos = GcovIO.unpack_uint32(buffer, cpos, packStr)
-
-            arcEntry = GcovGraphArc(blockNumber, destblock, flags)
-            arcSet.append(arcEntry)
+        arcCount = (header.length - 1) // 2
+        arcWords, cpos = GcovIO.unpack_uint32_array(buffer, cpos, arcCount * 2, packStr)
 
-            arcCount -= 1
-
-        rval = GcovNoteArcSetRecord(header, blockNumber, arcSet)
+        rval = GcovNoteArcSetRecord(header, blockNumber, arcWords[0::2], arcWords[1::2])
 
         return rval
 
@@ -223,20 +306,16 @@ class GcnoInfo:
         """
         cpos = pos
 
-        blockNumber, cpos = GcovIO.unpack_uint32(buffer, cpos, packStr)
-        artifical, cpos = GcovIO.unpack_uint32(buffer, cpos, packStr)
-        source_name_length, cpos = GcovIO.unpack_uint32(buffer, cpos, packStr)
+        blockNumber, artifical, source_name_length = LINE_SET_LAYOUT.get(packStr).unpack_from(buffer, cpos)
+        cpos += LINE_SET_LAYOUT.size
         source_name, cpos = GcovIO.unpack_string(buffer, cpos, source_name_length)
-        lineset = []
-
-        while True:
-            lineno, cpos = GcovIO.unpack_uint32(buffer, cpos, packStr)
-
-            if lineno == 0:
-                break
 
-            lineitem = GcovGraphLine(lineno)
-            lineset.append(lineitem)
+        lineWords, _ = GcovIO.unpack_uint32_array(buffer, cpos, (len(buffer) - cpos) // 4, packStr)
+        try:
+            # The line numbers are terminated by a zero
+            lineset = lineWords[:lineWords.index(0)]
+        except ValueError:
+            lineset = lineWords
 
         rval = GcovNoteLineSetRecord(header, blockNumber, lineset)
         return rval
@@ -254,6 +333,12 @@ class GcnoInfo:
         return rval
 
 
+# Fixed leading parts of the variable length records, without the record header
+FUNCTION_ANNOUNCEMENT_LAYOUT = GcovLayout("4I")
+FUNCTION_LOCATION_LAYOUT = GcovLayout("4I")
+LINE_SET_LAYOUT = GcovLayout("3I")
+
+
 class GcnoFileHeader:
     """
         uint32:magic
@@ -315,6 +400,7 @@ class GcnoRecordHeader:
     """
         uint32:tag uint32:length
     """
+    __slots__ = ('tag', 'length')
 
     def __init__(self, tag, length):
         self.tag = tag
@@ -351,12 +437,21 @@ class GcovNoteFunctionAnnouncementRecord:
 class GcovNoteArcSetRecord:
     """
         arcs: header uint32:block_no arc*
+
+        The arcs are stored as parallel destination/flag arrays, arcs builds GcovGraphArc views over them.
     """
+    __slots__ = ('header', 'block_number', 'destinations', 'flags')
 
-    def __init__(self, header, blockNumber, arcs):
+    def __init__(self, header, blockNumber, destinations, flags):
         self.header = header
         self.block_number = blockNumber
-        self.arcs = arcs
+        self.destinations = destinations
+        self.flags = flags
+
+    @property
+    def arcs(self):
+        blockNumber = self.block_number
+        return [GcovGraphArc(blockNumber, destBlock, flag) for destBlock, flag in zip(self.destinations, self.flags)]
 
     def print(self):
         print("ArcsRecord: BlockNumber=%d" % self.block_number)
@@ -368,12 +463,19 @@ class GcovNoteLineSetRecord:
         lines: header uint32:block_no line* => termline
             line:  uint32:line_no | uint32:0 string:filename
             termline: uint32:0 string:NULL
+
+        The line numbers are stored as an array, lines builds GcovGraphLine views over them.
     """
+    __slots__ = ('header', 'block_number', 'line_numbers')
 
-    def __init__(self, header, blockNumber, lines):
+    def __init__(self, header, blockNumber, line_numbers):
         self.header = header
         self.block_number = blockNumber
-        self.lines = lines
+        self.line_numbers = line_numbers
+
+    @property
+    def lines(self):
+        return [GcovGraphLine(number) for number in self.line_numbers]
 
     def print(self):
         print("LinesRecord: BlockNumber=%d" % self.block_number)
@@ -384,33 +486,53 @@ class GcovGraphArc:
     """
         uint32:dest_block uint32:flags
     """
+    __slots__ = ('source_block_number', 'destination_block_number', 'flag')
 
     def __init__(self, initBlock, destBlock, flag):
         self.source_block_number = initBlock
         self.destination_block_number = destBlock
         self.flag = flag
-        self.arc_id = None
-        self.counter = None
 
-        self.has_flag_fake = ((flag & GcovConst.GCOV_FLAG_ARC_FAKE) > 0)
-        self.has_flag_fall_through = ((flag & GcovConst.GCOV_FLAG_ARC_FALLTHROUGH) > 0)
-        self.has_flag_on_tree = ((flag & GcovConst.GCOV_FLAG_ARC_ON_TREE) > 0)
+    @property
+    def has_flag_fake(self):
+        return (self.flag & GcovConst.GCOV_FLAG_ARC_FAKE) > 0
 
-        self.is_relevant_branch = False
-        self.is_return_branch = False
-        self.is_exception_branch = False
+    @property
+    def has_flag_fall_through(self):
+        return (self.flag & GcovConst.GCOV_FLAG_ARC_FALLTHROUGH) > 0
+
+    @property
+    def has_flag_on_tree(self):
+        return (self.flag & GcovConst.GCOV_FLAG_ARC_ON_TREE) > 0
+
+    @property
+    def arc_id(self):
+        return None
+
+    @property
+    def counter(self):
+        return None
+
+    @property
+    def is_relevant_branch(self):
+        return False
+
+    @property
+    def is_return_branch(self):
+        return False
+
+    @property
+    def is_exception_branch(self):
+        return False
 
     def print(self):
         print("        GCovGraphArc:")
-        print("            DestBlock=%d" % self.dest_block)
-        print("            Flags=%d" % self.flags)
-        print("            ArcId=%d" % self.arc_id)
-        print("            Counter=%d" % self.counter)
+        print("            SourceBlock=%d" % self.source_block_number)
+        print("            DestBlock=%d" % self.destination_block_number)
+        print("            Flags=%d" % self.flag)
         print("            HasFlagFake=%d" % self.has_flag_fake)
         print("            HasFlagFallThrough=%d" % self.has_flag_fall_through)
         print("            HasFlagOnTree=%d" % self.has_flag_on_tree)
-        print("            IsRelevantBranch=" + self.is_relevant_branch)
-        print("            IsExceptionBranch=" + self.is_exception_branch)
 
         return
 
@@ -419,6 +541,7 @@ class GcovGraphLine:
     """
         uint32:line_no string:(filename | linestr | NULL)
     """
+    __slots__ = ('number',)
 
     def __init__(self, number):
         self.number = number
@@ -470,3 +593,11 @@ class GcovNoteBasicBlocksRecord:
     def print(self):
         print("BasicBlock: BlockCount=%d" % (self.block_count))
         return
+
+
+GCNO_CODEC = GcovRecordCodec("gcno")
+GCNO_CODEC.register(GcovConst.GCOV_TAG_FUNCTION, GcovNoteFunctionAnnouncementRecord,
+                    GcnoInfo.unpack_function_announcement)
+GCNO_CODEC.register(GcovConst.GCOV_TAG_BLOCKS, GcovNoteBasicBlocksRecord, GcnoInfo.unpack_basic_block)
+GCNO_CODEC.register(GcovConst.GCOV_TAG_ARCS, GcovNoteArcSetRecord, GcnoInfo.unpack_arc_set)
+GCNO_CODEC.register(GcovConst.GCOV_TAG_LINES, GcovNoteLineSetRecord, GcnoInfo.unpack_line_set)
@@ -45,4 +45,8 @@ GCOV_FLAG_ARC_ON_TREE = 1
 GCOV_FLAG_ARC_FAKE = 2
 GCOV_FLAG_ARC_FALLTHROUGH = 4
 
+# Fixed block numbers of every gcno function, gcc closes the flow graph with an implicit exit to entry arc
+GCOV_ENTRY_BLOCK = 0
+GCOV_EXIT_BLOCK = 1
+
 GCOVIO_STRINGPADDING = ['\x00\x00\x00\x00', '\x00\x00\x00', '\x00\x00', '\x00']
@@ -1,11 +1,26 @@
 import random
+import time
 
+import GcovConst
 from ConstraintPool import ConstraintPool
+from FlowSampler import FlowSampler
+from GcovGraph import GcovGraph
+from SolutionReservoir import SolutionReservoir
 from GcnoInfo import GcovNoteArcSetRecord, GcovNoteLineSetRecord
 from z3 import *
 
 
 class GcovConstraint:
+    # "z3" enumerates models with the SMT solver, "sampler" draws from the CFG cycle space and only falls back
+    # to z3 when the sampler cannot satisfy the request
+    SOLVER_BACKENDS = ("z3", "sampler")
+    backend = "z3"
+    # Unused z3 solutions of every function, shared so that one memory cap covers all of them
+    reservoir = SolutionReservoir()
+    max_models = 1001
+    # Wall clock budget of one solve in seconds, the enumeration stops and keeps what it found when it runs out
+    solve_timeout = 10.0
+
     def __init__(self, ident, records):
         self.ident = ident
         self.records = records
@@ -13,16 +28,82 @@ class GcovConstraint:
         self.counter_list = []
         self.block_list = []
         self.constraints = []
+        # Checksums of the gcno function announcement, None when unknown
+        self.lineno_checksum = None
+        self.cfg_checksum = None
+        self.constraint_pool = ConstraintPool()
+        self.arc_vars = {}
+        self.solver = None
+        self.sampler = None
+        self.graph = None
+        self.stats = SolveStats()
+
+    def __getstate__(self):  # skeleton only, z3 objects do not pickle and are rebuilt on demand
+        state = self.__dict__.copy()
+        state.update(records=[], constraint_pool=None, arc_vars={}, solver=None, sampler=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
         self.constraint_pool = ConstraintPool()
 
-    def extract_arc_list(self):  # extract all arcs with counter from gcno
+    def arc_var(self, arc):  # z3 variable of an arc, created once per (source, destination)
+        key = (arc.source_block_number, arc.destination_block_number)
+        var = self.arc_vars.get(key)
+        if var is None:
+            var = Int("arc" + str(key[0]) + "_" + str(key[1]))
+            self.arc_vars[key] = var
+        return var
+
+    def base_solver(self):  # flow model shared by every solve, mutation constraints go in a push() scope
+        if self.solver is None:
+            solver = Solver()
+            for constraint in self.flow_model():
+                solver.add(constraint)
+            self.solver = solver
+        return self.solver
+
+    def flow_model(self):
+        """
+            z3 constraints over the counter variables only.  The flow of an on-tree arc is derived from the
+            counters by propagating conservation through the spanning tree, as gcc does when it reads the
+            profile, so it becomes a linear expression instead of a variable of its own.  Arcs the counters do
+            not determine keep a variable, and the equations of blocks that did not take part in the
+            propagation are added explicitly.
+        """
+        graph = self.cfg()
+        flows = [None] * graph.arc_count
+        for counter, position in zip(self.counter_list, self.flow_sampler().counter_positions):
+            flows[position] = self.arc_var(counter)
+        used = self.flow_sampler().propagate(flows)
+
+        model = []
+        for position, arc in enumerate(self.arc_list):
+            if flows[position] is None:
+                flows[position] = self.arc_var(arc)
+            model.append(flows[position] >= (0 if graph.is_fake(position) else 10))
+
+        arc_position = {id(arc): position for position, arc in enumerate(self.arc_list)}
+        for constraint in self.constraints:
+            if constraint.outgoing_edge[0].source_block_number in used:
+                continue
+            incoming_sum = Sum([flows[arc_position[id(arc)]] for arc in constraint.incoming_edge])
+            outgoing_sum = Sum([flows[arc_position[id(arc)]] for arc in constraint.outgoing_edge])
+            model.append(incoming_sum == outgoing_sum)
+        return model
+
+    def cfg(self):  # CSR adjacency of arc_list, shared by constraint construction and the solver backends
+        if self.graph is None:
+            self.graph = GcovGraph.from_constraint(self)
+        return self.graph
+
+    def extract_arc_list(self):  # extract all arcs from gcno, the ones off the spanning tree carry a counter
         for record in self.records:
             if isinstance(record, GcovNoteArcSetRecord):
                 for arc in record.arcs:
-                    if arc.flag != 3:
-                        self.arc_list.append(arc)
-                        if arc.flag == 0 or arc.flag == 4:
-                            self.counter_list.append(arc)
+                    self.arc_list.append(arc)
+                    if not arc.has_flag_on_tree:
+                        self.counter_list.append(arc)
 
     def extract_block_list(self):  # extract all blocks with line number from gcno
         for record in self.records:
@@ -32,65 +113,213 @@ class GcovConstraint:
     def construct_constraint(self):
         self.extract_block_list()
         self.extract_arc_list()
-        for block in self.block_list:
-            outgoing_arc = []
-            incoming_arc = []
-            for arc in self.arc_list:
-                if arc.source_block_number == block:
-                    outgoing_arc.append(arc)
-                elif arc.destination_block_number == block:
-                    incoming_arc.append(arc)
+        graph = self.cfg()
+        # gcc conserves flow at every block but entry and exit, which the implicit exit to entry arc joins
+        for block in range(graph.node_count):
+            if block == GcovConst.GCOV_ENTRY_BLOCK or block == GcovConst.GCOV_EXIT_BLOCK:
+                continue
+            outgoing_arc = [self.arc_list[arc] for arc in graph.out_edges(block)]
+            incoming_arc = [self.arc_list[arc] for arc in graph.in_edges(block)]
             if len(outgoing_arc) == 0 or len(incoming_arc) == 0:
                 continue
             constraint = Constraint(incoming_arc, outgoing_arc)
             self.constraints.append(constraint)
 
     def solve(self, index, value):
+        """
+            Solves with counter index set to value, together with a pooled constraint set picked by the power
+            schedule.  Returns (solution, pool parent the solution satisfies or None, seconds); nothing is
+            recorded, the caller does that with record_solution() once the solution is applied.
+        """
+        parent = self.select_parent(index)
+        start = time.perf_counter()
+        solution, pooled = self.solve_pooled(index, value, list(parent.constraint) if parent is not None else [])
+        return solution, parent if pooled else None, time.perf_counter() - start
+
+    def select_parent(self, index):  # pool entry to solve under, sets that pin counter index themselves are skipped
+        return self.constraint_pool.select(lambda entry: not self.pins_counter(entry.constraint, index))
+
+    def solve_pooled(self, index, value, base):
+        """
+            solve_under() with the pooled constraints base, retried without them when only they make it unsat.
+            Returns (solution, whether base was kept).
+        """
+        solution = self.solve_under(index, value, base)
+        if solution is None:
+            print("unsatisfiable with the pooled constraints, solving without them")
+            return self.solve_under(index, value, []), False
+        return solution, True
+
+    def record_solution(self, index, value, parent, seconds):  # the constraints of the mutant, for schedule()
+        base = list(parent.constraint) if parent is not None else []
+        self.constraint_pool.record(base + [self.arc_var(self.counter_list[index]) == value], parent)
+        self.constraint_pool.record_cost(seconds)
+
+    def solve_under(self, index, value, base):
+        """
+            Solves with counter index set to value under the extra constraints base.  Returns the counters, False
+            when there is no solution, or None when only base makes it unsat; that solve is left out of stats,
+            which should reflect the function and not the pool.
+        """
         print("solving...")
-        solver = Solver()
-        for arc in self.arc_list:
-            solver.add(Int("arc" + str(arc.source_block_number) + "_" + str(arc.destination_block_number)) >= 10)
-        for constraint in self.constraints:
-            incoming_arc = constraint.incoming_edge
-            outgoing_arc = constraint.outgoing_edge
-            incoming_sum, outgoing_sum = 0, 0
-            for arc in incoming_arc:
-                incoming_sum += Int("arc" + str(arc.source_block_number) + "_" + str(arc.destination_block_number))
-            for arc in outgoing_arc:
-                outgoing_sum += Int("arc" + str(arc.source_block_number) + "_" + str(arc.destination_block_number))
-            solver.add(incoming_sum == outgoing_sum)
-        assign_constraint = Int("arc" + str(self.counter_list[index].source_block_number) + "_" + str(
-            self.counter_list[index].destination_block_number)) == value
-        solver.add(assign_constraint)
-        if self.constraint_pool.get():
-            new_constraint = random.choice(self.constraint_pool.get())
-            for c in new_constraint:
-                solver.add(c)
-        else:
-            new_constraint = []
-        new_constraint.append(assign_constraint)
-        self.constraint_pool.record(new_constraint)
-        solutions = []
-        while solver.check() == sat:
-            if len(solutions) > 1000:
-                break
-            model = solver.model()
-            solution = []
-            for counter in self.counter_list:
-                solution.append(
-                    model[Int("arc" + str(counter.source_block_number) + "_" + str(
-                        counter.destination_block_number))].as_long())
-            solutions.append(solution)
-            block = []
-            for d in model:
-                c = d()
-                block.append(c != model[d])
-            solver.add(Or(block))
+        if self.backend == "sampler":
+            pins = self.pins(base)
+            solution = self.sample(index, value, pins) if pins is not None else None
+            if solution is not None:
+                print("solution found")
+                return solution
+            print("sampler failed, falling back to z3")
+        start = time.perf_counter()
+        solver = self.base_solver()
+        solver.push()
+        try:
+            solutions, models, timed_out = self.enumerate_solutions(solver, index, value, base)
+        finally:
+            solver.pop()
+        if base and models == 0 and not timed_out:
+            return None
+        self.stats.record(time.perf_counter() - start, models, timed_out)
         if not solutions:
-            print("no solution found")
+            print("no solution found (timed out)" if timed_out else "no solution found")
             return False
-        print("solution found")
-        return random.choice(solutions)
+        print("solution found (partial enumeration)" if timed_out else "solution found")
+        solution = solutions.pop(random.randrange(len(solutions)))
+        self.reservoir.add((self, index), solutions)
+        return solution
+
+    def pins_counter(self, constraints, index):
+        name = str(self.arc_var(self.counter_list[index]))
+        return any(str(c.arg(0)) == name for c in constraints)
+
+    def pins(self, base):  # {counter index: value} of a list of counter == value constraints, None for others
+        counter_names = {str(self.arc_var(counter)): index for index, counter in enumerate(self.counter_list)}
+        pins = {}
+        for name, value in GcovConstraint.encode_constraint(base):
+            if name not in counter_names:
+                return None
+            pins[counter_names[name]] = value
+        return pins
+
+    def draw(self, index):  # a stored solution pinned at counter index, None when the reservoir has none
+        return self.reservoir.draw((self, index))
+
+    def flow_sampler(self):
+        if self.sampler is None:
+            self.sampler = FlowSampler(self)
+        return self.sampler
+
+    def sample(self, index, value, pins=None):
+        # The sampler takes at most one pin besides the new assignment, more are left to z3
+        if pins and len(pins) > 1:
+            return None
+        return self.flow_sampler().sample(index, value, pins)
+
+    def perturb(self, counters):  # shift a delta along one cycle of the current counters, no solver involved
+        return self.flow_sampler().perturb(counters)
+
+    def checkpoint_state(self):  # solver statistics and constraint pool as plain data, None if there is nothing yet
+        pool = self.constraint_pool
+        if not self.stats.solves and not len(pool) and not len(pool.similarity_index):
+            return None
+        return {"stats": self.stats, "pool": pool.checkpoint_state(GcovConstraint.encode_constraint)}
+
+    def restore_state(self, state):
+        self.stats = state["stats"]
+        self.constraint_pool.restore_state(state["pool"], GcovConstraint.decode_constraint)
+
+    @staticmethod
+    def encode_constraint(constraint):  # [(variable name, value)] of a list of arc == value constraints
+        return [(str(c.arg(0)), c.arg(1).as_long()) for c in constraint]
+
+    @staticmethod
+    def decode_constraint(items):
+        return [Int(name) == value for name, value in items]
+
+    def enumerate_solutions(self, solver, index, value, base):
+        solver.add(self.arc_var(self.counter_list[index]) == value)
+        for c in base:
+            solver.add(c)
+        counter_vars = [self.arc_var(counter) for counter in self.counter_list]
+
+        deadline = time.perf_counter() + self.solve_timeout
+        status = {"timed_out": False}
+
+        def models():
+            for _ in range(self.max_models):
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    status["timed_out"] = True
+                    return
+                solver.set("timeout", max(1, int(remaining * 1000)))
+                result = solver.check()
+                if result == unknown:
+                    status["timed_out"] = True
+                    return
+                if result != sat:
+                    return
+                model = solver.model()
+                yield [model[var].as_long() for var in counter_vars]
+                block = []
+                for d in model:
+                    c = d()
+                    block.append(c != model[d])
+                solver.add(Or(block))
+
+        # One solution is returned, the rest of the sample goes to the reservoir
+        solutions, seen = SolutionReservoir.sample(models(), self.reservoir.capacity + 1)
+        return solutions, seen, status["timed_out"]
+
+
+class SolveStats:
+    """
+        Per function solver statistics, used to skip functions whose solves keep failing or timing out.
+        timeouts counts solves that ran out of budget without a model, partial the ones that ran out after
+        finding some.
+    """
+    # A function is blacklisted after min_solves solves if most of them failed or timed out
+    min_solves = 3
+    max_failure_rate = 0.8
+
+    def __init__(self):
+        self.solves = 0
+        self.unsat = 0
+        self.timeouts = 0
+        self.partial = 0
+        self.models = 0
+        self.seconds = 0.0
+
+    def record(self, seconds, models, timed_out):
+        self.solves += 1
+        self.seconds += seconds
+        self.models += models
+        if models == 0 and timed_out:
+            self.timeouts += 1
+        elif models == 0:
+            self.unsat += 1
+        elif timed_out:
+            self.partial += 1
+
+    def merge(self, other):
+        self.solves += other.solves
+        self.unsat += other.unsat
+        self.timeouts += other.timeouts
+        self.partial += other.partial
+        self.models += other.models
+        self.seconds += other.seconds
+
+    @property
+    def unsat_rate(self):
+        return self.unsat / self.solves if self.solves else 0.0
+
+    @property
+    def blacklisted(self):
+        if self.solves < self.min_solves:
+            return False
+        return (self.unsat + self.timeouts) / self.solves >= self.max_failure_rate
+
+    def __repr__(self):
+        return "solves=%d unsat=%d timeouts=%d partial=%d models=%d seconds=%.2f" % (
+            self.solves, self.unsat, self.timeouts, self.partial, self.models, self.seconds)
 
 
 class Constraint:
@@ -0,0 +1,80 @@
+from array import array
+
+import GcovConst
+
+
+class GcovGraph:
+    """
+        Compressed sparse row (CSR) adjacency of one function's CFG, built in a single linear pass.
+
+        == Arrays ==
+        out_offsets[node] .. out_offsets[node + 1] slice out_arcs, the arc positions leaving node
+        in_offsets[node] .. in_offsets[node + 1] slice in_arcs, the arc positions entering node
+        sources[arc], destinations[arc] end points of arc
+        flags[arc] gcno arc flags (on tree, fake, fall through)
+        counter_index[arc] position of arc in the counter list, or -1 when gcov does not instrument it
+
+        Arcs keep their arc list order inside every slice.
+    """
+
+    def __init__(self, sources, destinations, node_count, flags=None, counter_positions=()):
+        self.node_count = node_count
+        self.sources = array('I', sources)
+        self.destinations = array('I', destinations)
+        self.flags = array('I', flags) if flags is not None else array('I', [0]) * len(self.sources)
+
+        self.counter_index = array('i', [-1]) * len(self.sources)
+        for index, position in enumerate(counter_positions):
+            self.counter_index[position] = index
+
+        self.out_offsets, self.out_arcs = GcovGraph.csr(self.sources, node_count)
+        self.in_offsets, self.in_arcs = GcovGraph.csr(self.destinations, node_count)
+        return
+
+    @classmethod
+    def from_constraint(cls, constraint):
+        """
+            Graph over the block numbers of a GcovConstraint, with arc positions indexing its arc_list.
+        """
+        arcs = constraint.arc_list
+        sources = [arc.source_block_number for arc in arcs]
+        destinations = [arc.destination_block_number for arc in arcs]
+        node_count = max(max(sources, default=-1), max(destinations, default=-1), max(constraint.block_list, default=-1)) + 1
+
+        arc_position = {id(arc): position for position, arc in enumerate(arcs)}
+        counter_positions = [arc_position[id(arc)] for arc in constraint.counter_list]
+        return cls(sources, destinations, node_count, [arc.flag for arc in arcs], counter_positions)
+
+    @staticmethod
+    def csr(keys, node_count):
+        """
+            Counting sort of the positions of keys by key, returns (offsets, positions).
+        """
+        offsets = array('I', [0]) * (node_count + 1)
+        for key in keys:
+            offsets[key + 1] += 1
+        for node in range(node_count):
+            offsets[node + 1] += offsets[node]
+
+        fill = array('I', offsets)
+        positions = array('I', [0]) * len(keys)
+        for position, key in enumerate(keys):
+            positions[fill[key]] = position
+            fill[key] += 1
+        return offsets, positions
+
+    @property
+    def arc_count(self):
+        return len(self.sources)
+
+    def out_edges(self, node):
+        return self.out_arcs[self.out_offsets[node]: self.out_offsets[node + 1]]
+
+    def in_edges(self, node):
+        return self.in_arcs[self.in_offsets[node]: self.in_offsets[node + 1]]
+
+    def is_on_tree(self, arc):
+        return (self.flags[arc] & GcovConst.GCOV_FLAG_ARC_ON_TREE) > 0
+
+    def is_fake(self, arc):
+        return (self.flags[arc] & GcovConst.GCOV_FLAG_ARC_FAKE) > 0
@@ -1,4 +1,10 @@
+import os
+import shutil
 import struct
+import sys
+import tempfile
+from array import array
+from collections.abc import Sequence
 
 import GcovConst
 
@@ -28,6 +34,87 @@ class GcovIO:
 
         return val, cpos
 
+    @staticmethod
+    def unpack_uint64_array(buffer, pos, count, packStr=GcovConst.PACKUINT32):
+        """
+            uint64*:  (uint32:low uint32:high)*
+
+            Decodes count consecutive uint64 items in one call and returns them as an array('Q').
+        """
+        cpos = pos + count * 8
+        data = buffer[pos: cpos]
+
+        if packStr == GcovConst.PACKUINT32 and sys.byteorder == 'little':
+            # The on-disk layout is already a native little-endian uint64 vector
+            counters = array('Q')
+            counters.frombytes(data)
+            return counters, cpos
+
+        words = array('I')
+        words.frombytes(data)
+        if (packStr == GcovConst.PACKUINT32) != (sys.byteorder == 'little'):
+            words.byteswap()
+        if sys.byteorder == 'big':
+            # Native uint64 is high word first, the file stores the low word first
+            words[0::2], words[1::2] = words[1::2], words[0::2]
+
+        counters = array('Q')
+        counters.frombytes(words.tobytes())
+        return counters, cpos
+
+    @staticmethod
+    def unpack_uint32_array(buffer, pos, count, packStr=GcovConst.PACKUINT32):
+        """
+            uint32*
+
+            Decodes count consecutive uint32 items in one call and returns them as an array('I').
+        """
+        cpos = pos + count * 4
+
+        words = array('I')
+        words.frombytes(buffer[pos: cpos])
+        if (packStr == GcovConst.PACKUINT32) != (sys.byteorder == 'little'):
+            words.byteswap()
+        return words, cpos
+
+    @staticmethod
+    def unpack_uint64_view(buffer, pos, count, packStr=GcovConst.PACKUINT32):
+        """
+            uint64*:  (uint32:low uint32:high)*
+
+            Zero-copy variant of unpack_uint64_array for memoryview buffers, it falls back to a decoded
+            array('Q') when the file layout does not match the host.
+        """
+        cpos = pos + count * 8
+        if isinstance(buffer, memoryview) and packStr == GcovConst.PACKUINT32 and sys.byteorder == 'little':
+            return buffer[pos: cpos].cast('Q'), cpos
+        return GcovIO.unpack_uint64_array(buffer, pos, count, packStr)
+
+    @staticmethod
+    def pack_uint64_array(values, packStr=GcovConst.PACKUINT32):
+        """
+            uint64*:  (uint32:low uint32:high)*
+
+            Encodes a sequence of uint64 items into a single bytes object.
+        """
+        if isinstance(values, memoryview) and values.format == 'Q':
+            counters = values
+        elif isinstance(values, array) and values.typecode == 'Q':
+            counters = values
+        else:
+            counters = array('Q', values)
+
+        if packStr == GcovConst.PACKUINT32 and sys.byteorder == 'little':
+            return counters.tobytes()
+
+        words = array('I')
+        words.frombytes(counters.tobytes())
+        if sys.byteorder == 'big':
+            words[0::2], words[1::2] = words[1::2], words[0::2]
+        if (packStr == GcovConst.PACKUINT32) != (sys.byteorder == 'little'):
+            words.byteswap()
+        return words.tobytes()
+
     @staticmethod
     def unpack_string(buffer, pos, strWords):
 
@@ -37,13 +124,98 @@ class GcovIO:
             strlen = strWords * 4
             strend = pos + strlen
 
-            buffSlice = buffer[pos: strend]
+            buffSlice = bytes(buffer[pos: strend])
             val = buffSlice.rstrip(b'\x00').decode()
 
             cpos = pos + strlen
 
         return val, cpos
 
+    @staticmethod
+    def index_records(buffer, pos, end, packStr=GcovConst.PACKUINT32, zero_tags=()):
+        """
+            record: header data
+            header: uint32:tag uint32:length
+
+            Walks the record headers once without decoding any data and returns the (tags, offsets, lengths)
+            arrays.  Length is in 4 byte words.  A record of one of zero_tags stored with a negative length
+            has no data in the file, its offset is -1.
+        """
+        tags = array('I')
+        offsets = array('q')
+        lengths = array('I')
+
+        header = struct.Struct(packStr[0] + "II")
+        cpos = pos
+
+        while end - cpos >= 8:
+            tag, length = header.unpack_from(buffer, cpos)
+            cpos += 8
+
+            if tag in zero_tags and length & 0x80000000:
+                tags.append(tag)
+                offsets.append(-1)
+                lengths.append(2 ** 32 - length)
+                continue
+
+            tags.append(tag)
+            offsets.append(cpos)
+            lengths.append(length)
+            cpos += length * 4
+
+        return tags, offsets, lengths
+
+    @staticmethod
+    def index_functions(tags, ident_at):
+        """
+            Groups the records of a file by function.  A function starts at its GCOV_TAG_FUNCTION record
+            and owns the following per-function records (tags 0x01xxxxxx) up to the next announcement or
+            summary.  ident_at(index) returns the ident of the announcement record at index.
+
+            Returns a dict of ident -> GcovFunctionEntry in file order.
+        """
+        functions = {}
+        entry = None
+
+        for index, tag in enumerate(tags):
+            if tag == GcovConst.GCOV_TAG_FUNCTION:
+                if entry is not None:
+                    entry.end = index
+                entry = GcovFunctionEntry(ident_at(index), index)
+                functions[entry.ident] = entry
+            elif entry is not None and (tag >> 24) == (GcovConst.GCOV_TAG_FUNCTION >> 24):
+                entry.records.setdefault(tag, []).append(index)
+            elif entry is not None:
+                entry.end = index
+                entry = None
+
+        if entry is not None:
+            entry.end = len(tags)
+
+        return functions
+
+    @staticmethod
+    def group_functions(records):
+        """
+            Groups a stream of decoded records by function, see index_functions.  Yields (ident, records)
+            for every function and (None, [record]) for every record outside of a function.
+        """
+        ident = None
+        group = []
+
+        for record in records:
+            tag = record.header.tag
+            if tag == GcovConst.GCOV_TAG_FUNCTION or (tag >> 24) != (GcovConst.GCOV_TAG_FUNCTION >> 24):
+                if group:
+                    yield ident, group
+                ident = record.ident if tag == GcovConst.GCOV_TAG_FUNCTION else None
+                group = [record]
+            else:
+                group.append(record)
+
+        if group:
+            yield ident, group
+
     @staticmethod
     def read_quad_char(file_handle):
         """
@@ -124,4 +296,168 @@ class GcovIO:
 
         # Write the high order word
         GcovIO.write_uint32(file_handle, highOrder)
-        return
\ No newline at end of file
+        return
+
+    @staticmethod
+    def write_file_atomic(filename, buffer):
+        """
+            Writes buffer to a temporary file next to filename in one call and renames it into place,
+            so a reader never sees a partially written file.
+        """
+        dir_name = os.path.dirname(os.path.abspath(filename))
+        fd, tmp_name = tempfile.mkstemp(prefix=os.path.basename(filename) + ".", suffix=".tmp", dir=dir_name)
+        try:
+            with os.fdopen(fd, 'wb') as file_handle:
+                file_handle.write(buffer)
+            if os.path.exists(filename):
+                shutil.copymode(filename, tmp_name)
+            else:
+                os.chmod(tmp_name, 0o644)
+            os.replace(tmp_name, filename)
+        except BaseException:
+            if os.path.exists(tmp_name):
+                os.remove(tmp_name)
+            raise
+        return
+
+    @staticmethod
+    def write_uint64_array(file_handle, values, packStr=GcovConst.PACKUINT32):
+        """
+            uint64*:  (uint32:low uint32:high)*
+        """
+        file_handle.write(GcovIO.pack_uint64_array(values, packStr))
+        return
+
+
+class GcovFunctionEntry:
+    """
+        Record index range [start, end) of one function, start is its announcement record.  records maps
+        the tag of every other record in the range to the indices of the records with that tag.
+    """
+    __slots__ = ('ident', 'start', 'end', 'records')
+
+    def __init__(self, ident, start, end=None):
+        self.ident = ident
+        self.start = start
+        self.end = end
+        self.records = {}
+        return
+
+    def indices(self, tag):
+        return self.records.get(tag, ())
+
+    def first(self, tag):
+        indices = self.records.get(tag)
+        return indices[0] if indices else None
+
+
+class GcovLazyRecords(Sequence):
+    """
+        Record list over a mapped gcov file.  Only the compact (tag, offset, length) index is kept
+        up front, a record is built by decode(tag, length, items_data) the first time it is accessed.
+        items_data is a memoryview into the mapping, so nothing is copied until decode needs it.
+    """
+
+    def __init__(self, buffer, tags, offsets, lengths, decode):
+        self.buffer = buffer
+        self.tags = tags
+        self.offsets = offsets
+        self.lengths = lengths
+        self.decode = decode
+        self._records = [None] * len(tags)
+        return
+
+    def __len__(self):
+        return len(self._records)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        record = self._records[index]
+        if record is None:
+            record = self._decode_at(index)
+            self._records[index] = record
+        return record
+
+    def __setitem__(self, index, record):
+        self._records[index] = record
+
+    def is_decoded(self, index):
+        return self._records[index] is not None
+
+    def _decode_at(self, index):
+        length = self.lengths[index]
+        offset = self.offsets[index]
+        if offset < 0:
+            items_data = bytes(length * 4)
+        else:
+            items_data = self.buffer[offset: offset + length * 4]
+        return self.decode(self.tags[index], length, items_data)
+
+
+class GcovLayout:
+    """
+        A fixed record layout precompiled as struct.Struct for both byte orders.
+    """
+    __slots__ = ('format', 'size', 'little', 'big')
+
+    def __init__(self, fmt):
+        self.format = fmt
+        self.little = struct.Struct(GcovConst.PACKUINT32[0] + fmt)
+        self.big = struct.Struct(GcovConst.PACKUINT32_BIGENDIAN[0] + fmt)
+        self.size = self.little.size
+        return
+
+    def get(self, packStr=GcovConst.PACKUINT32):
+        return self.big if packStr == GcovConst.PACKUINT32_BIGENDIAN else self.little
+
+
+# Every record starts with this header
+RECORD_HEADER_LAYOUT = GcovLayout("II")
+
+
+class GcovRecordCodec:
+    """
+        Record kind registry of one file kind.  Decoding dispatches on the record tag, encoding on the
+        record type, both with a single dict lookup.
+
+            decode(header, buffer, pos, packStr) -> record
+            size(record) -> packed size in bytes, header included (or a fixed int)
+            pack(buffer, pos, record, packStr) -> position after the packed record
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.decoders = {}
+        self.encoders = {}
+        return
+
+    def register(self, tag, record_type, decode, pack=None, size=None):
+        self.decoders[tag] = decode
+        if pack is not None:
+            self.encoders[record_type] = (size, pack)
+        return
+
+    def decode(self, header, buffer, pos=0, packStr=GcovConst.PACKUINT32):
+        decode = self.decoders.get(header.tag)
+        if decode is None:
+            raise IOError("Un-recognized tag (0x%x) found in %s file." % (header.tag, self.name))
+        return decode(header, buffer, pos, packStr)
+
+    def size(self, record):
+        """
+            Unknown record kinds have size 0, they are not written.
+        """
+        encoder = self.encoders.get(type(record))
+        if encoder is None:
+            return 0
+        size, _ = encoder
+        return size if isinstance(size, int) else size(record)
+
+    def pack(self, buffer, pos, record, packStr=GcovConst.PACKUINT32):
+        encoder = self.encoders.get(type(record))
+        if encoder is None:
+            return pos
+        _, pack = encoder
+        return pack(buffer, pos, record, packStr)
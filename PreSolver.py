@@ -0,0 +1,142 @@
+import multiprocessing
+import random
+import time
+from collections import deque
+
+from GcdaInfo import GCovDataCounterBaseRecord
+from GcovConstraint import GcovConstraint, SolveStats
+from utils import select_method_by_block, apply_counters, save_mutated, MUTATION_ATTEMPTS
+
+# Constraint skeletons of the gcda a worker solves for, set once per worker process
+_worker_constraints = None
+
+
+def _init_worker(method_constraint_dict, backend, solve_timeout):
+    global _worker_constraints
+    _worker_constraints = method_constraint_dict
+    GcovConstraint.backend = backend
+    GcovConstraint.solve_timeout = solve_timeout
+
+
+def _solve(ident, index, value, base):
+    """
+        Runs in a worker, under the pooled constraints base (GcovConstraint.encode_constraint) picked by the
+        main process, whose pools the workers do not have.  Returns (solution, leftover solutions, SolveStats
+        of this solve, whether base was kept, seconds).
+    """
+    constraint = _worker_constraints[ident]
+    constraint.stats = SolveStats()
+    start = time.perf_counter()
+    solution, pooled = constraint.solve_pooled(index, value, GcovConstraint.decode_constraint(base))
+    return (solution, GcovConstraint.reservoir.take((constraint, index)), constraint.stats, pooled,
+            time.perf_counter() - start)
+
+
+class PreSolver:
+    """
+        Producer-consumer replacement for gcda_mutate: a process pool keeps depth solves in flight for
+        upcoming mutations while the main loop compiles and runs the previous mutant.
+
+        Workers get the pickled constraint skeletons of gcda.method_constraint_dict once, at start up.  The
+        constraint pools stay in the main process, which picks the pool parent of a solve and sends its
+        constraints along with the task.  The solution of a finished solve becomes the next mutation, its
+        leftover solutions go to the shared reservoir of the main process, and a later mutation of the same
+        counter is served from there without a round trip to the pool.
+    """
+
+    def __init__(self, gcda, workers, depth=None):
+        self.gcda = gcda
+        self.depth = depth if depth is not None else 2 * workers
+        self.pending = deque()
+        self.pool = multiprocessing.Pool(workers, initializer=_init_worker,
+                                         initargs=(gcda.method_constraint_dict, GcovConstraint.backend,
+                                                   GcovConstraint.solve_timeout))
+        self.fill()
+        return
+
+    def fill(self):
+        gcda = self.gcda
+        for _ in range(MUTATION_ATTEMPTS):
+            if len(self.pending) >= self.depth:
+                break
+            ident = select_method_by_block(gcda.method_block_dict)
+            constraints = gcda.method_constraint_dict[ident]
+            record = gcda.get_counter_record(ident)
+            if not isinstance(record, GCovDataCounterBaseRecord) or len(record.counters) == 0:
+                continue
+            if constraints.stats.blacklisted:
+                continue
+
+            index = random.randint(0, len(record.counters) - 1)
+            solution = constraints.draw(index)
+            if solution is not None:
+                self.pending.append((ident, index, None, solution, None))
+            else:
+                value = random.randint(0, 2 ** 10 - 1)
+                parent = constraints.select_parent(index)
+                base = GcovConstraint.encode_constraint(parent.constraint) if parent is not None else []
+                task = self.pool.apply_async(_solve, (ident, index, value, base))
+                self.pending.append((ident, index, task, None, parent))
+        return
+
+    def next_ready(self):
+        """
+            Removes and returns the first finished pending mutation, waiting for the oldest if none is.
+        """
+        for position, (_, _, task, _, _) in enumerate(self.pending):
+            if task is None or task.ready():
+                entry = self.pending[position]
+                del self.pending[position]
+                return entry
+        return self.pending.popleft()
+
+    def mutate(self, function_count=1):
+        print("mutating...")
+        gcda = self.gcda
+        mutated = {}
+        function_count = min(function_count, len(gcda.method_block_dict))
+        for _ in range(MUTATION_ATTEMPTS * function_count):
+            if len(mutated) >= function_count:
+                break
+            self.fill()
+            if not self.pending:
+                break
+
+            ident, index, task, solution, parent = self.next_ready()
+            constraints = gcda.method_constraint_dict[ident]
+            if ident not in mutated:
+                constraints.constraint_pool.clear_record()
+            seconds = 0.0
+            if task is not None:
+                solution, leftovers, stats, pooled, seconds = task.get()
+                constraints.stats.merge(stats)
+                if not pooled:
+                    parent = None
+                if isinstance(solution, list):
+                    GcovConstraint.reservoir.add((constraints, index), leftovers)
+                elif constraints.stats.blacklisted:
+                    print("blacklisted function " + str(ident) + ": " + str(constraints.stats))
+
+            if not isinstance(solution, list):
+                continue
+            if ident in mutated:
+                # Already mutated in this round, keep the solution for a later one
+                GcovConstraint.reservoir.add((constraints, index), [solution])
+                continue
+            if not apply_counters(gcda, ident, gcda.get_counter_record(ident), solution):
+                continue
+            constraints.record_solution(index, solution[index], parent, seconds)
+            mutated[ident] = constraints
+
+        if not mutated:
+            print("no mutation found in " + str(MUTATION_ATTEMPTS) + " attempts")
+            return []
+        save_mutated(gcda, mutated)
+        self.fill()
+        print("solution reservoir: " + str(GcovConstraint.reservoir.stats()))
+        return list(mutated.values())
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+        return
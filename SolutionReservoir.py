@@ -0,0 +1,102 @@
+import random
+from array import array
+from collections import OrderedDict
+
+
+class SolutionReservoir:
+    """
+        Bounded store of flow-consistent counter solutions that were found but not used yet.
+
+        Solutions are kept per (GcovConstraint, pinned counter index), at most capacity per key.  A draw
+        removes the solution, so every stored solution becomes at most one mutant.  Counters are stored as
+        UInt64 arrays and the whole store is capped at max_bytes, evicting the least recently used keys.
+    """
+
+    def __init__(self, capacity=32, max_bytes=64 << 20):
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        self.solutions = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        return
+
+    @staticmethod
+    def sample(solutions, capacity, rng=random):
+        """
+            Streaming reservoir sampling (algorithm R): a uniform sample of at most capacity items from an
+            iterable of unknown length.  Returns (sample, seen).
+        """
+        sample = []
+        seen = 0
+        for solution in solutions:
+            seen += 1
+            if len(sample) < capacity:
+                sample.append(solution)
+            else:
+                slot = rng.randrange(seen)
+                if slot < capacity:
+                    sample[slot] = solution
+        return sample, seen
+
+    def add(self, key, solutions):
+        stored = self.solutions.setdefault(key, [])
+        self.solutions.move_to_end(key)
+        for solution in solutions:
+            if len(stored) >= self.capacity:
+                break
+            try:
+                counters = array('Q', solution)
+            except OverflowError:
+                continue
+            stored.append(counters)
+            self.bytes += counters.itemsize * len(counters)
+
+        if not stored:
+            del self.solutions[key]
+        while self.bytes > self.max_bytes and self.solutions:
+            _, evicted = self.solutions.popitem(last=False)
+            self.bytes -= sum(counters.itemsize * len(counters) for counters in evicted)
+            self.evictions += len(evicted)
+        return
+
+    def draw(self, key, rng=random):
+        """
+            Removes and returns a random stored solution for key as a list, or None.
+        """
+        stored = self.solutions.get(key)
+        if not stored:
+            self.misses += 1
+            return None
+
+        slot = rng.randrange(len(stored))
+        stored[slot], stored[-1] = stored[-1], stored[slot]
+        counters = stored.pop()
+        self.bytes -= counters.itemsize * len(counters)
+        if stored:
+            self.solutions.move_to_end(key)
+        else:
+            del self.solutions[key]
+        self.hits += 1
+        return counters.tolist()
+
+    def take(self, key):
+        """
+            Removes and returns every stored solution for key as lists, without counting hits.
+        """
+        stored = self.solutions.pop(key, [])
+        self.bytes -= sum(counters.itemsize * len(counters) for counters in stored)
+        return [counters.tolist() for counters in stored]
+
+    def discard(self, owner):
+        """
+            Drops every key whose first item is owner.
+        """
+        for key in [key for key in self.solutions if key[0] is owner]:
+            self.bytes -= sum(counters.itemsize * len(counters) for counters in self.solutions.pop(key))
+        return
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "keys": len(self.solutions), "bytes": self.bytes}
@@ -0,0 +1,296 @@
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+import GcovConst
+from GcdaInfo import GcdaInfo
+from GcnoInfo import GcnoInfo
+
+
+class SyntheticGcov:
+    """
+        Generates a gcno/gcda pair in the layout GcnoInfo and GcdaInfo read.
+
+        Every function gets a chain of basic blocks with random forward and backward branches, one line
+        record per block, a counter base record with one counter per arc off the spanning tree and an
+        all-zero time profiler record.  A zero_ratio share of the functions get all-zero counters, which
+        gcc stores with a negative length and no data.
+    """
+
+    def __init__(self, function_count, block_range=(4, 30), zero_ratio=0.1, big_endian=False, seed=0):
+        self.function_count = function_count
+        self.block_range = block_range
+        self.zero_ratio = zero_ratio
+        self.pack_str32 = GcovConst.PACKUINT32_BIGENDIAN if big_endian else GcovConst.PACKUINT32
+        self.big_endian = big_endian
+        self.rng = random.Random(seed)
+        return
+
+    def words(self, *values):
+        return struct.pack(self.pack_str32[0] + "%dI" % len(values), *values)
+
+    def string(self, value):
+        data = value.encode() + b'\x00'
+        data += b'\x00' * (-len(data) % 4)
+        return self.words(len(data) // 4) + data
+
+    def record(self, tag, payload):
+        return self.words(tag, len(payload) // 4) + payload
+
+    def function_arcs(self, block_count):
+        """
+            Returns [(source, destination, flags)] for blocks 0 (entry), 1 (exit) and 2..block_count-1.
+        """
+        rng = self.rng
+        body = list(range(2, block_count))
+        arcs = [(0, body[0], GcovConst.GCOV_FLAG_ARC_ON_TREE)]
+
+        # gcc joins exit and entry before building the spanning tree, so the arc into exit closes the
+        # entry -> chain -> exit path into a cycle and stays off the tree, with a counter
+        for i, block in enumerate(body):
+            if i + 1 < len(body):
+                arcs.append((block, body[i + 1],
+                             GcovConst.GCOV_FLAG_ARC_ON_TREE | GcovConst.GCOV_FLAG_ARC_FALLTHROUGH))
+            else:
+                arcs.append((block, 1, GcovConst.GCOV_FLAG_ARC_FALLTHROUGH))
+            if i + 2 < len(body) and rng.random() < 0.4:
+                arcs.append((block, body[rng.randint(i + 2, len(body) - 1)], 0))
+            elif i > 0 and rng.random() < 0.2:
+                arcs.append((block, body[rng.randint(0, i - 1)], 0))
+
+        return arcs
+
+    def generate(self):
+        """
+            Returns the (gcno, gcda) file contents.
+        """
+        rng = self.rng
+        words = self.words
+
+        gcno_magic = GcovConst.GCNO_FILE_MAGIC_BIGENDIAN if self.big_endian else GcovConst.GCNO_FILE_MAGIC
+        gcda_magic = GcovConst.GCDA_FILE_MAGIC_BIGENDIAN if self.big_endian else GcovConst.GCDA_FILE_MAGIC
+        gcno = [gcno_magic, b'*31B', words(0x1234), self.string("/tmp"), words(0)]
+        gcda = [gcda_magic, b'*31B', words(0x1234), self.record(GcovConst.GCOV_TAG_OBJECT_SUMMARY, words(1, 3))]
+
+        for ident in range(1, self.function_count + 1):
+            block_count = rng.randint(*self.block_range)
+            arcs = self.function_arcs(block_count)
+
+            gcno.append(self.record(GcovConst.GCOV_TAG_FUNCTION,
+                                    words(ident, 111, 222) + self.string("f%d" % ident) + words(0) +
+                                    self.string("test.c") + words(ident, 1, ident + 1, 1)))
+            gcno.append(self.record(GcovConst.GCOV_TAG_BLOCKS, words(block_count)))
+
+            arcs_by_block = {}
+            for source, destination, flags in arcs:
+                arcs_by_block.setdefault(source, []).extend((destination, flags))
+            for block, arc_words in arcs_by_block.items():
+                gcno.append(self.record(GcovConst.GCOV_TAG_ARCS, words(block, *arc_words)))
+            for block in range(2, block_count):
+                gcno.append(self.record(GcovConst.GCOV_TAG_LINES,
+                                        words(block, 0) + self.string("test.c") + words(block, 0, 0)))
+
+            counter_count = sum(1 for arc in arcs if not arc[2] & GcovConst.GCOV_FLAG_ARC_ON_TREE)
+            gcda.append(self.record(GcovConst.GCOV_TAG_FUNCTION, words(ident, 111, 222)))
+            if counter_count and rng.random() < self.zero_ratio:
+                gcda.append(words(GcovConst.GCOV_TAG_COUNTER_BASE, 2 ** 32 - counter_count * 2))
+            else:
+                counters = [rng.randint(1, 2 ** 40) for _ in range(counter_count)]
+                payload = [word for counter in counters for word in (counter & GcovConst.LOWORDERMASK, counter >> 32)]
+                gcda.append(self.record(GcovConst.GCOV_TAG_COUNTER_BASE, words(*payload)))
+            gcda.append(words(GcovConst.GCOV_TAG_TIME_PROFILER, 2 ** 32 - 2))
+
+        return b''.join(gcno), b''.join(gcda)
+
+
+def timed(func, setup=None):
+    """
+        Seconds spent in func(setup()), the setup call is not timed.
+    """
+    argument = setup() if setup is not None else None
+    start = time.perf_counter()
+    func(argument)
+    return time.perf_counter() - start
+
+
+def measure(name, gcno_file, gcda_file, repeat, lazy):
+    """
+        Times the parser phases on one file pair, best of repeat.  Runs in its own process so that the
+        reported peak RSS belongs to this case only.
+    """
+    result = {"case": name, "lazy": lazy, "phases": {}}
+    out_dir = tempfile.mkdtemp(prefix="gcov_bench_")
+    out_file = os.path.join(out_dir, "out.gcda")
+
+    def phase(phase_name, size, record_count, func, setup=None):
+        seconds = max(min(timed(func, setup) for _ in range(repeat)), 1e-9)
+        result["phases"][phase_name] = {"seconds": seconds,
+                                        "records_per_second": record_count / seconds,
+                                        "mb_per_second": size / 1e6 / seconds}
+
+    def loaded(info_type, file_name):
+        def setup():
+            info = info_type(filename=file_name)
+            info.load(lazy=lazy)
+            return info
+        return setup
+
+    def pulled(info_type, file_name):
+        def setup():
+            info = loaded(info_type, file_name)()
+            pull_all(info)
+            return info
+        return setup
+
+    def pull_all(info):
+        info.pull_records()
+        if lazy:
+            # Lazily loaded records are only decoded when accessed
+            for _ in info.records:
+                pass
+
+    def round_trip(_):
+        info = loaded(GcdaInfo, gcda_file)()
+        pull_all(info)
+        info.save(out_file)
+
+    gcda_size = os.path.getsize(gcda_file)
+    gcda_records = len(loaded(GcdaInfo, gcda_file)().records)
+    result["gcda_bytes"] = gcda_size
+    result["gcda_records"] = gcda_records
+
+    phase("gcda_load", gcda_size, gcda_records, lambda _: loaded(GcdaInfo, gcda_file)())
+    phase("gcda_pull_records", gcda_size, gcda_records, pull_all, loaded(GcdaInfo, gcda_file))
+    phase("gcda_save", gcda_size, gcda_records, lambda info: info.save(out_file), pulled(GcdaInfo, gcda_file))
+    phase("gcda_round_trip", gcda_size, gcda_records, round_trip)
+
+    with open(gcda_file, 'rb') as original, open(out_file, 'rb') as saved:
+        result["gcda_round_trip_identical"] = original.read() == saved.read()
+
+    if gcno_file is not None:
+        gcno_size = os.path.getsize(gcno_file)
+        gcno_records = len(loaded(GcnoInfo, gcno_file)().records)
+        result["gcno_bytes"] = gcno_size
+        result["gcno_records"] = gcno_records
+
+        phase("gcno_load", gcno_size, gcno_records, lambda _: loaded(GcnoInfo, gcno_file)())
+        phase("gcno_pull_records", gcno_size, gcno_records, pull_all, loaded(GcnoInfo, gcno_file))
+        phase("gcno_iter_records", gcno_size, gcno_records,
+              lambda _: sum(1 for _ in GcnoInfo().iter_records(gcno_file)))
+
+    result["peak_rss_mb"] = peak_rss_mb()
+
+    os.remove(out_file)
+    os.rmdir(out_dir)
+    return result
+
+
+def peak_rss_mb():
+    """
+        Peak RSS of this process.  ru_maxrss keeps the high-water mark of the parent across fork and exec,
+        so VmHWM, which starts over with the address space of the exec'd interpreter, is used where it exists.
+    """
+    try:
+        with open("/proc/self/status") as file_handle:
+            for line in file_handle:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1e3
+    except OSError:
+        pass
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / (1e6 if sys.platform == "darwin" else 1e3)
+
+
+def write_case(case, gcno_file, gcda_file):
+    """
+        Generates a synthetic pair and writes it, run in a worker so the main process never holds the bytes.
+    """
+    gcno_bytes, gcda_bytes = case.generate()
+    with open(gcno_file, 'wb') as file_handle:
+        file_handle.write(gcno_bytes)
+    with open(gcda_file, 'wb') as file_handle:
+        file_handle.write(gcda_bytes)
+
+
+def build_cases(sizes, seed):
+    """
+        Yields (name, gcno_file, gcda_file) for the synthetic pairs and the sample files in data/.
+    """
+    for size in sizes:
+        for big_endian in (False, True):
+            name = "synthetic_%d_%s" % (size, "be" if big_endian else "le")
+            yield name, SyntheticGcov(size, big_endian=big_endian, seed=seed)
+
+    # A few very large functions, to stress long counter arrays
+    yield "synthetic_long_counters_le", SyntheticGcov(10, block_range=(20000, 40000), seed=seed)
+
+    for gcda_file in sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "*.gcda"))):
+        yield "data_" + os.path.splitext(os.path.basename(gcda_file))[0], gcda_file
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput benchmark for the GcdaInfo/GcnoInfo parsers")
+    parser.add_argument("--sizes", default="10,100,1000,10000,100000",
+                        help="comma separated synthetic function counts")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per phase, the best one is reported")
+    parser.add_argument("--lazy", action="store_true", help="load with the mmap-backed lazy mode")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="bench_output.json", help="machine readable result file")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",") if size]
+    results = []
+
+    with tempfile.TemporaryDirectory(prefix="gcov_bench_") as work_dir:
+        # spawn with one task per child gives generation and every measurement a fresh interpreter, so the
+        # reported peak RSS is that of the measured case alone
+        context = multiprocessing.get_context("spawn")
+        with context.Pool(1, maxtasksperchild=1) as pool:
+            for name, case in build_cases(sizes, args.seed):
+                if isinstance(case, SyntheticGcov):
+                    gcno_file = os.path.join(work_dir, name + ".gcno")
+                    gcda_file = os.path.join(work_dir, name + ".gcda")
+                    pool.apply(write_case, (case, gcno_file, gcda_file))
+                else:
+                    gcno_file, gcda_file = None, case
+
+                result = pool.apply(measure, (name, gcno_file, gcda_file, args.repeat, args.lazy))
+                results.append(result)
+
+                summary = ", ".join("%s %.4fs" % (phase, values["seconds"])
+                                    for phase, values in result["phases"].items())
+                print("%s: %s, peak RSS %.1f MB" % (name, summary, result["peak_rss_mb"]))
+
+    report = {"revision": git_revision(),
+              "timestamp": int(time.time()),
+              "python": platform.python_version(),
+              "platform": platform.platform(),
+              "repeat": args.repeat,
+              "lazy": args.lazy,
+              "results": results}
+    with open(args.output, 'w') as file_handle:
+        json.dump(report, file_handle, indent=2)
+    print("Results written to %s" % args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,7 +3,7 @@ import random
 import sys
 
 import utils
-from GcdaInfo import GcdaInfo, GCovDataFunctionAnnouncementRecord
+from GcdaInfo import GcdaInfo
 from GcnoInfo import GcnoInfo
 
 
@@ -11,11 +11,8 @@ def modify_gcda(gcda_name, index, counter):  # index: the index of the function
     gcda = GcdaInfo()
     gcda.load(gcda_name)
     gcda.pull_records()
-    records = gcda.records
-    function_index = [records.index(record) for record in records if
-                      isinstance(record, GCovDataFunctionAnnouncementRecord)]
-    function_index = function_index[index]
-    records[function_index + 1].counters = counter
+    ident = list(gcda.functions)[index]
+    gcda.get_counter_record(ident).counters = counter
     gcda.save(gcda_name)
 
 
@@ -1,41 +1,123 @@
-import sys
+import argparse
 
+from Checkpoint import Checkpoint
 from GcdaInfo import GCovDataFunctionAnnouncementRecord
+from PreSolver import PreSolver
 from utils import *
 
 
 def main():
-    if len(sys.argv) != 5:
-        print("Usage: python3 main.py <dir_path> <file_name> <mutation_number> <generator>")
-    dir_path = sys.argv[1]
-    file_name = sys.argv[2]
-    mutation_number = int(sys.argv[3])
-    generator = sys.argv[4]
-    optimization_levels = ["O1", "O2", "O3", "Os", "Og", "Ofast"]
-    optimization_level = random.choice(optimization_levels)
+    parser = argparse.ArgumentParser(description="Profile guided differential fuzzing of gcc")
+    parser.add_argument("dir_path")
+    parser.add_argument("file_name")
+    parser.add_argument("mutation_number", type=int)
+    parser.add_argument("generator", choices=["csmith", "yarpgen"])
+    parser.add_argument("solver", nargs="?", default=GcovConstraint.backend, choices=GcovConstraint.SOLVER_BACKENDS)
+    parser.add_argument("--mutator", default="solve", choices=MUTATORS,
+                        help="solve for new counters or perturb the current ones along a CFG cycle")
+    parser.add_argument("--functions", type=int, default=1, metavar="K",
+                        help="functions mutated per recompile")
+    parser.add_argument("--schedule", action="store_true",
+                        help="keep constraints of mutants with new binary similarity and reuse them by energy")
+    parser.add_argument("--presolve", type=int, default=0, metavar="WORKERS",
+                        help="solve upcoming mutations in a pool of WORKERS processes while compiling")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue an interrupted run from its checkpoint, keeping the generated program")
+    parser.add_argument("--checkpoint-every", type=int, default=10, metavar="N",
+                        help="save a checkpoint every N mutations, 0 to disable")
+    args = parser.parse_args()
+    dir_path = args.dir_path
+    file_name = args.file_name
+    mutation_number = args.mutation_number
+    generator = args.generator
+    GcovConstraint.backend = args.solver
+    checkpoint = Checkpoint(dir_path + "test" + file_name + ".checkpoint")
+    state = checkpoint.load() if args.resume else None
+    if state is not None and state["generator"] != generator:
+        print("checkpoint is for " + state["generator"] + ", starting over")
+        state = None
+    if state is None:
+        checkpoint.remove()
+        optimization_levels = ["O1", "O2", "O3", "Os", "Og", "Ofast"]
+        optimization_level = random.choice(optimization_levels)
+        start = 0
+    else:
+        optimization_level = state["optimization_level"]
+        random.setstate(state["random"])
+        start = state["iteration"]
+        print("resuming at mutation " + str(start) + " with -" + optimization_level)
+    resume = state is not None
+    presolvers = []
     if generator == "csmith":
-        gcda = init_csmith(dir_path, file_name, optimization_level)
-        for i in range(mutation_number):
-            constraint = gcda_mutate(gcda)
+        gcda = init_csmith(dir_path, file_name, optimization_level, resume)
+        gcdas = [gcda]
+        if resume:
+            restore_gcda(gcda, state["functions"][0])
+        mutate = make_mutator(gcda, args, presolvers)
+        for i in range(start, mutation_number):
+            save_checkpoint(checkpoint, args, i, start, generator, optimization_level, gcdas)
+            constraints = mutate()
+            if not constraints:
+                # The gcda is unchanged, recompiling would only repeat the last run
+                continue
             res = gcc_recompile_csmith(gcda, optimization_level)
             if res == -100:
                 continue
-            differential_test(gcda)
-            # constraint.constraint_pool.schedule(gcda)
+            bug = differential_test(gcda)
+            if args.schedule:
+                for constraint in constraints:
+                    constraint.constraint_pool.schedule(gcda, bug)
     elif generator == "yarpgen":
-        gcda_driver, gcda_func = init_yarpgen(dir_path, file_name, optimization_level)
-        for i in range(mutation_number):
-            constraint_driver = gcda_mutate(gcda_driver)
-            constraint_func = gcda_mutate(gcda_func)
+        gcda_driver, gcda_func = init_yarpgen(dir_path, file_name, optimization_level, resume)
+        gcdas = [gcda_driver, gcda_func]
+        if resume:
+            restore_gcda(gcda_driver, state["functions"][0])
+            restore_gcda(gcda_func, state["functions"][1])
+        mutate_driver = make_mutator(gcda_driver, args, presolvers)
+        mutate_func = make_mutator(gcda_func, args, presolvers)
+        for i in range(start, mutation_number):
+            save_checkpoint(checkpoint, args, i, start, generator, optimization_level, gcdas)
+            constraints_driver = mutate_driver()
+            constraints_func = mutate_func()
+            if not constraints_driver and not constraints_func:
+                continue
             res = gcc_recompile_yarpgen(gcda_driver, optimization_level)
             if res == -100:
                 continue
-            differential_test(gcda_driver)
-            # constraint_driver.constraint_pool.schedule(gcda_driver)
-            # constraint_func.constraint_pool.schedule(gcda_func)
+            bug = differential_test(gcda_driver)
+            if args.schedule:
+                for constraint in constraints_driver:
+                    constraint.constraint_pool.schedule(gcda_driver, bug)
+                for constraint in constraints_func:
+                    constraint.constraint_pool.schedule(gcda_func, bug)
     else:
         print("Generator must be csmith or yarpgen")
         exit(-1)
+    save_checkpoint(checkpoint, args, mutation_number, start, generator, optimization_level, gcdas, force=True)
+    for presolver in presolvers:
+        presolver.close()
+
+
+def save_checkpoint(checkpoint, args, iteration, start, generator, optimization_level, gcdas, force=False):
+    # The gcda files on disk already hold the last mutation, the checkpoint only adds what is in memory
+    if args.checkpoint_every <= 0:
+        return
+    if not force and (iteration == start or iteration % args.checkpoint_every != 0):
+        return
+    checkpoint.save({"generator": generator,
+                     "optimization_level": optimization_level,
+                     "iteration": iteration,
+                     "random": random.getstate(),
+                     "functions": [checkpoint_gcda(gcda) for gcda in gcdas]})
+
+
+def make_mutator(gcda, args, presolvers):
+    # Pre-solving only applies to solver based mutations, perturbation needs no solver
+    if args.presolve > 0 and args.mutator == "solve":
+        presolver = PreSolver(gcda, args.presolve)
+        presolvers.append(presolver)
+        return lambda: presolver.mutate(args.functions)
+    return lambda: gcda_mutate(gcda, args.mutator, args.functions)
 
 
 if __name__ == "__main__":
@@ -1,11 +1,14 @@
+import hashlib
 import os
 import random
 import shutil
 import subprocess
 import time
 
-from GcdaInfo import GcdaInfo, GCovDataCounterBaseRecord, GCovDataFunctionAnnouncementRecord
-from GcnoInfo import GcnoInfo, GcovNoteFunctionAnnouncementRecord
+from GcdaInfo import GcdaInfo, GCovDataCounterBaseRecord
+from GcdaValidator import GcdaValidator
+from GcnoCache import GcnoCache
+from GcnoInfo import GcnoInfo, GcovNoteBasicBlocksRecord, GcovNoteFunctionAnnouncementRecord
 from GcovConstraint import GcovConstraint
 
 
@@ -19,89 +22,111 @@ def select_method_by_block(method_block_dict):
             random_number -= method_block_dict[method]
 
 
-def construct_constraint(gcno):
-    records = gcno.records
-    function_announce_record_index = [records.index(record) for record in records if
-                                      isinstance(record, GcovNoteFunctionAnnouncementRecord)]
-    function_announce_record_index.append(len(records))
+def build_constraint(ident, records):
+    # records of one function, starting with its announcement
+    constraint = GcovConstraint(ident, records[2:])
+    if isinstance(records[0], GcovNoteFunctionAnnouncementRecord):
+        constraint.lineno_checksum = records[0].lineno_checksum
+        constraint.cfg_checksum = records[0].cfg_checksum
+    constraint.construct_constraint()
+    return constraint
+
+
+def get_basic_info(gcno_file_name, cache=None):
+    if cache is None:
+        cache = GcnoCache()
+    key = GcnoCache.cache_key(gcno_file_name)
+    cached = cache.load(key)
+    if cached is not None:
+        return cached
+
+    # Streams the gcno one function at a time instead of loading every record first
     method_constraint_dict = {}
-    for i in range(len(function_announce_record_index) - 1):
-        ident = records[function_announce_record_index[i]].ident
-        method_constraint_dict[ident] = GcovConstraint(ident, records[function_announce_record_index[i] + 2:
-                                                                      function_announce_record_index[i + 1]])
-        method_constraint_dict[ident].construct_constraint()
-    return method_constraint_dict
-
-
-def construct_block(gcno):
-    records = gcno.records
-    function_announce_record_index = [records.index(record) for record in records if
-                                      isinstance(record, GcovNoteFunctionAnnouncementRecord)]
     method_block_dict = {}
-    for i in range(len(function_announce_record_index)):
-        ident = records[function_announce_record_index[i]].ident
-        method_block_dict[ident] = records[function_announce_record_index[i] + 1].block_count
-    return method_block_dict
+    for ident, records in GcnoInfo().iter_records(gcno_file_name):
+        if ident is None:
+            continue
+        method_constraint_dict[ident] = build_constraint(ident, records)
+        method_block_dict[ident] = next(
+            (record.block_count for record in records if isinstance(record, GcovNoteBasicBlocksRecord)), 0)
+
+    try:
+        cache.save(key, method_constraint_dict, method_block_dict)
+    except OSError as e:
+        print("Could not write gcno cache: " + str(e))
+    return method_constraint_dict, method_block_dict
 
 
 def get_basic_info_csmith(file_name):
-    gcno = GcnoInfo()
-    gcno.load(file_name + ".gcno")
-    gcno.pull_records()
-    method_constraint_dict = construct_constraint(gcno)
-    method_block_dict = construct_block(gcno)
-    return method_constraint_dict, method_block_dict
+    return get_basic_info(file_name + ".gcno")
 
 
-def init_csmith(dir_path, file_name, optimization_level):
+def init_csmith(dir_path, file_name, optimization_level, resume=False):
+    # resume keeps the generated program and its builds from an interrupted run
     file_name = "test" + file_name
-    if os.path.exists(dir_path + file_name):
-        shutil.rmtree(dir_path + file_name)
-    os.makedirs(dir_path + file_name)
-    os.chdir(dir_path + file_name)
+    prepare_dir(dir_path + file_name, resume)
     file_name = "test" + file_name + "/" + optimization_level
-    if os.path.exists(dir_path + file_name):
-        shutil.rmtree(dir_path + file_name)
-    os.makedirs(dir_path + file_name)
-    os.chdir(dir_path + file_name)
-    gcda = generate_compile_csmith(file_name, optimization_level)
+    prepare_dir(dir_path + file_name, resume)
+    if resume and os.path.exists(file_name) and os.path.exists(file_name + "_mut-" + file_name + ".gcda"):
+        gcda = load_gcda(file_name + "_mut-" + file_name + ".gcda")
+    else:
+        gcda = generate_compile_csmith(file_name, optimization_level)
+    build_clang_reference(gcda.target_binary_name, [gcda.target_binary_name + ".c"])
     gcda.method_constraint_dict, gcda.method_block_dict = get_basic_info_csmith(file_name)
-    gcda.function_index = [gcda.records.index(record) for record in gcda.records if
-                           isinstance(record, GCovDataFunctionAnnouncementRecord)]
     return gcda
 
 
+def prepare_dir(path, resume):
+    if os.path.exists(path) and not resume:
+        shutil.rmtree(path)
+    os.makedirs(path, exist_ok=True)
+    os.chdir(path)
+
+
+def load_gcda(gcda_file_name):
+    gcda = GcdaInfo()
+    gcda.load(gcda_file_name)
+    gcda.pull_records()
+    return gcda
+
+
+def checkpoint_gcda(gcda):  # {ident: state} of the functions with solver statistics or pooled constraints
+    states = {}
+    for ident, constraints in gcda.method_constraint_dict.items():
+        state = constraints.checkpoint_state()
+        if state is not None:
+            states[ident] = state
+    return states
+
+
+def restore_gcda(gcda, states):
+    for ident, state in states.items():
+        if ident in gcda.method_constraint_dict:
+            gcda.method_constraint_dict[ident].restore_state(state)
+
+
 def get_basic_info_yarpgen(file_name):
-    gcno_driver = GcnoInfo()
-    gcno_driver.load(file_name + "-driver.gcno")
-    gcno_driver.pull_records()
-    gcno_func = GcnoInfo()
-    gcno_func.load(file_name + "-func.gcno")
-    gcno_func.pull_records()
-    method_constraint_dict_driver = construct_constraint(gcno_driver)
-    method_block_dict_driver = construct_block(gcno_driver)
-    method_constraint_dict_func = construct_constraint(gcno_func)
-    method_block_dict_func = construct_block(gcno_func)
+    method_constraint_dict_driver, method_block_dict_driver = get_basic_info(file_name + "-driver.gcno")
+    method_constraint_dict_func, method_block_dict_func = get_basic_info(file_name + "-func.gcno")
     return method_constraint_dict_driver, method_block_dict_driver, method_constraint_dict_func, method_block_dict_func
 
 
-def init_yarpgen(dir_path, file_name, optimization_level):
+def init_yarpgen(dir_path, file_name, optimization_level, resume=False):
     file_name = "test" + file_name
-    if os.path.exists(dir_path + file_name):
-        shutil.rmtree(dir_path + file_name)
-    os.makedirs(dir_path + file_name)
-    os.chdir(dir_path + file_name)
-    gcda_driver, gcda_func = generate_compile_yarpgen(file_name, optimization_level)
+    prepare_dir(dir_path + file_name, resume)
+    if (resume and os.path.exists(file_name) and os.path.exists(file_name + "_mut-driver.gcda") and
+            os.path.exists(file_name + "_mut-func.gcda")):
+        gcda_driver = load_gcda(file_name + "_mut-driver.gcda")
+        gcda_func = load_gcda(file_name + "_mut-func.gcda")
+    else:
+        gcda_driver, gcda_func = generate_compile_yarpgen(file_name, optimization_level)
+    build_clang_reference(gcda_driver.target_binary_name, ["driver.c", "func.c"])
     method_constraint_dict_driver, method_block_dict_driver, method_constraint_dict_func, method_block_dict_func = get_basic_info_yarpgen(
         file_name)
     gcda_driver.method_constraint_dict = method_constraint_dict_driver
     gcda_driver.method_block_dict = method_block_dict_driver
     gcda_func.method_constraint_dict = method_constraint_dict_func
     gcda_func.method_block_dict = method_block_dict_func
-    gcda_driver.function_index = [gcda_driver.records.index(record) for record in gcda_driver.records if
-                                  isinstance(record, GCovDataFunctionAnnouncementRecord)]
-    gcda_func.function_index = [gcda_func.records.index(record) for record in gcda_func.records if
-                                isinstance(record, GCovDataFunctionAnnouncementRecord)]
     return gcda_driver, gcda_func
 
 
@@ -124,13 +149,7 @@ def generate_compile_yarpgen(file_name, optimization_level):
     execute_command(cmd)
     shutil.copyfile(file_name + "-func.gcda", file_name + "_mut-func.gcda")
     shutil.copyfile(file_name + "-driver.gcda", file_name + "_mut-driver.gcda")
-    gcda_driver = GcdaInfo()
-    gcda_driver.load(file_name + "_mut-driver.gcda")
-    gcda_driver.pull_records()
-    gcda_func = GcdaInfo()
-    gcda_func.load(file_name + "_mut-func.gcda")
-    gcda_func.pull_records()
-    return gcda_driver, gcda_func
+    return load_gcda(file_name + "_mut-driver.gcda"), load_gcda(file_name + "_mut-func.gcda")
 
 
 def generate_compile_csmith(file_name, optimization_level):
@@ -152,16 +171,37 @@ def generate_compile_csmith(file_name, optimization_level):
     execute_command(cmd)
     # delete_old_gcda(file_name, file_name)
     shutil.copyfile(file_name + ".gcda", file_name + "_mut-" + file_name + ".gcda")
-    gcda = GcdaInfo()
-    gcda.load(file_name + "_mut-" + file_name + ".gcda")
-    gcda.pull_records()
-    return gcda
+    return load_gcda(file_name + "_mut-" + file_name + ".gcda")
+
+
+def build_clang_reference(target_binary_name, source_files):
+    # clang never reads the gcda, so its build and output are the same for every mutant of a program.
+    # They are kept as <target>_clang and <target>_clang.txt and rebuilt only when the sources change.
+    digest = hashlib.sha256()
+    for source_file in source_files:
+        with open(source_file, 'rb') as file_handle:
+            digest.update(file_handle.read())
+    source_hash = digest.hexdigest()
+    reference = target_binary_name + "_clang"
+    hash_file = reference + ".sha256"
+    if os.path.exists(reference + ".txt") and os.path.exists(hash_file):
+        with open(hash_file) as file_handle:
+            if file_handle.read() == source_hash:
+                return 0
+
+    print("building clang reference...")
+    res = execute_command(" ".join(["clang", "-w"] + source_files + ["-o", reference]))
+    if res != 0:
+        return res
+    execute_command(f"./{reference} > {reference}.txt 2>&1")
+    with open(hash_file, 'w') as file_handle:
+        file_handle.write(source_hash)
+    return 0
 
 
 def gcc_recompile_csmith(gcda, optimization_level):
     print("recompiling...")
     base_cmd = ["gcc", "-w", "-fprofile-use"]
-    clang_cmd = ["clang", "-w"]
     optimization_level = "-" + optimization_level
     source_file = gcda.target_binary_name + ".c"
     output_base = gcda.target_binary_name + "_mut"
@@ -172,13 +212,6 @@ def gcc_recompile_csmith(gcda, optimization_level):
     if res == -100:
         return -100
     execute_command(f"./{output_base} > {compiled_name} 2>&1")
-    # Clang Compilation
-    clang_compiled_name = output_base + "_clang.txt"
-    cmd = clang_cmd + [source_file, "-o", output_base]
-    res = execute_command(" ".join(cmd))
-    if res == -100:
-        return -100
-    execute_command(f"./{output_base} > {clang_compiled_name} 2>&1")
     return 0
 
 
@@ -186,7 +219,7 @@ def differential_test(gcda):
     print("differential testing...")
     target_binary_name = gcda.target_binary_name
     cmd = "diff " + target_binary_name + ".txt " + target_binary_name + "_mut.txt"
-    execute_command(cmd)
+    return execute_command(cmd) != 0
 
 
 def delete_old_file(target_binary_name):
@@ -205,7 +238,6 @@ def delete_old_gcda(source_code_name, target_binary_name):
 def gcc_recompile_yarpgen(gcda_driver, optimization_level):
     print("recompiling...")
     base_cmd = ["gcc", "-w", "-fprofile-use"]
-    clang_cmd = ["clang", "-w"]
     driver_file = "driver.c"
     func_file = "func.c"
     optimization_level = "-" + optimization_level
@@ -217,37 +249,92 @@ def gcc_recompile_yarpgen(gcda_driver, optimization_level):
     if res == -100:
         return -100
     execute_command(f"./{output_base} > {compiled_name} 2>&1")
-    # Clang Compilation
-    clang_compiled_name = output_base + "_clang.txt"
-    cmd = clang_cmd + [driver_file, func_file, "-o", output_base]
-    res = execute_command(" ".join(cmd))
-    if res == -100:
-        return -100
-    execute_command(f"./{output_base} > {clang_compiled_name} 2>&1")
     return 0
 
 
-def gcda_mutate(gcda):
+MUTATORS = ("solve", "perturb")
+# Functions tried by one gcda_mutate call before it gives up and leaves the gcda unchanged
+MUTATION_ATTEMPTS = 100
+
+
+def gcda_mutate(gcda, mutator="solve", function_count=1):
+    # "solve" replaces the counters of a function with a new solution, "perturb" edits the current ones.
+    # function_count distinct functions are mutated and written with one save, so one recompile covers all.
+    # Returns the GcovConstraint of every mutated function, empty when nothing was mutated
     print("mutating...")
-    while True:
+    mutated = {}
+    function_count = min(function_count, len(gcda.method_block_dict))
+    while len(mutated) < function_count:
+        method_indent_driver = mutate_function(gcda, mutator, mutated)
+        if method_indent_driver is None:
+            break
+        constraints = gcda.method_constraint_dict[method_indent_driver]
+        mutated[method_indent_driver] = constraints
+    if not mutated:
+        print("no mutation found in " + str(MUTATION_ATTEMPTS) + " attempts")
+        return []
+    save_mutated(gcda, mutated)
+    if mutator == "solve":
+        print("solution reservoir: " + str(GcovConstraint.reservoir.stats()))
+    return list(mutated.values())
+
+
+def save_mutated(gcda, mutated):
+    file_name = gcda.target_binary_name + "_mut-" + gcda.source_file_name + ".gcda"
+    if len(mutated) == 1:
+        gcda.save_counters(next(iter(mutated)), file_name)
+    else:
+        gcda.save(file_name)
+
+
+def mutate_function(gcda, mutator, skip=()):
+    # mutates the counters of one function not in skip, returns its ident or None after MUTATION_ATTEMPTS tries
+    for _ in range(MUTATION_ATTEMPTS):
         method_indent_driver = select_method_by_block(gcda.method_block_dict)
-        index = 0
-        for index in gcda.function_index:
-            if gcda.records[index].ident == method_indent_driver:
-                break
+        if method_indent_driver in skip:
+            continue
         constraints = gcda.method_constraint_dict[method_indent_driver]
-        record = gcda.records[index + 1]
-        if isinstance(record, GCovDataCounterBaseRecord):
+        constraints.constraint_pool.clear_record()
+        record = gcda.get_counter_record(method_indent_driver)
+        if isinstance(record, GCovDataCounterBaseRecord) and mutator == "perturb":
+            result = constraints.perturb(record.counters)
+            if result is not None and apply_counters(gcda, method_indent_driver, record, result):
+                return method_indent_driver
+            elif len(record.counters) == 1:
+                return method_indent_driver
+        elif isinstance(record, GCovDataCounterBaseRecord):
+            if constraints.stats.blacklisted:
+                continue
             index = random.randint(0, len(record.counters) - 1)
-            value = random.randint(0, 2 ** 10 - 1)
-            result = constraints.solve(index, value)
-            if isinstance(result, list):
-                record.counters = result
-                break
+            result = constraints.draw(index)
+            parent = None
+            seconds = 0.0
+            if result is None:
+                value = random.randint(0, 2 ** 10 - 1)
+                result, parent, seconds = constraints.solve(index, value)
+                if constraints.stats.blacklisted:
+                    print("blacklisted function " + str(method_indent_driver) + ": " + str(constraints.stats))
+            if isinstance(result, list) and apply_counters(gcda, method_indent_driver, record, result):
+                constraints.record_solution(index, result[index], parent, seconds)
+                return method_indent_driver
             elif len(record.counters) == 1:
-                break
-    gcda.save(gcda.target_binary_name + "_mut-" + gcda.source_file_name + ".gcda")
-    return constraints
+                return method_indent_driver
+    return None
+
+
+def apply_counters(gcda, ident, record, counters):
+    # sets the counters of record, or keeps the old ones and returns False if the validator rejects the new ones
+    previous = record.counters
+    record.counters = counters
+    # one validator per gcda, rebuilt only when its constraint skeletons are replaced
+    if gcda.validator is None or gcda.validator.method_constraint_dict is not gcda.method_constraint_dict:
+        gcda.validator = GcdaValidator(gcda)
+    problems = gcda.validator.validate_function(ident)
+    if problems:
+        record.counters = previous
+        print("rejected mutant: " + "; ".join(problems))
+        return False
+    return True
 
 
 def execute_command(command):